@@ -0,0 +1,366 @@
+"""Benchmarks for the crop, split, resize and encode hot paths.
+
+Generates synthetic images (portrait, landscape, ultra-wide panorama, RGBA
+PNG, large WEBP), then times decode, crop, resize and encode separately for
+each preset, plus the split and preview paths and a full engine run. The
+resize-first ordering (--resize-first in the CLI) is timed next to the
+default one, with its PSNR against the default output, and every encoder
+profile is timed with its output size. Each sample and preset runs in a
+fresh process, so its peak RSS is its own; on Linux the peak is also reset
+and recorded for every stage. Results are written as JSON so runs can be
+compared (latency and memory):
+
+    python benchmarks/bench_crop.py --output before.json
+    python benchmarks/bench_crop.py --output after.json --compare before.json
+
+Use --scale 0.25 for a quick smoke run.
+"""
+import argparse
+import ctypes
+import gc
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PIL
+from PIL import Image, ImageChops, ImageStat
+
+import crop_engine
+import crop_saliency
+from crop_engine import PRESETS, CropEngine, ImageSource
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    libc = ctypes.CDLL("libc.so.6")
+except OSError:  # Not glibc
+    libc = None
+
+# name -> (size, mode, extension) at scale 1.0
+SAMPLES = {
+    "portrait": ((4000, 6000), "RGB", ".jpg"),
+    "landscape": ((6000, 4000), "RGB", ".jpg"),
+    "pano": ((24000, 4000), "RGB", ".jpg"),
+    "rgba_png": ((3000, 3000), "RGBA", ".png"),
+    "large_webp": ((6000, 4000), "RGB", ".webp"),
+}
+
+# Canvas size used by the GUI's cropped preview
+PREVIEW_CANVAS = (250, 250)
+
+# A stage counts as a regression in --compare when its p50 grows by more than
+# this fraction and by at least REGRESSION_MIN_MS (to ignore sub-ms jitter)
+REGRESSION_THRESHOLD = 0.10
+REGRESSION_MIN_MS = 1.0
+# Same for peak RSS, ignoring growth below this many MB
+REGRESSION_MIN_MB = 5.0
+
+
+def make_sample(size, mode):
+    """Gradients plus noise: compresses like a photo rather than flat colour or pure noise"""
+    noise = Image.effect_noise(size, 24)
+    horizontal = Image.linear_gradient("L").rotate(90).resize(size)
+    vertical = Image.linear_gradient("L").resize(size)
+    img = Image.merge("RGB", (horizontal, vertical, noise))
+    if mode == "RGBA":
+        alpha = Image.radial_gradient("L").resize(size)
+        img.putalpha(alpha)
+    return img
+
+
+def write_samples(directory, scale):
+    paths = {}
+    for name, (size, mode, ext) in SAMPLES.items():
+        size = (max(int(size[0] * scale), 64), max(int(size[1] * scale), 64))
+        path = os.path.join(directory, name + ext)
+        img = make_sample(size, mode)
+        if ext == ".jpg":
+            img.save(path, quality=90)
+        else:
+            img.save(path)
+        paths[name] = path
+    return paths
+
+
+def peak_rss_mb():
+    """High-water mark of this process's RSS (since the last reset_peak_rss() on Linux)"""
+    try:
+        # Unlike ru_maxrss, VmHWM honours reset_peak_rss()
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def reset_peak_rss():
+    """Restart the RSS high-water mark at the current RSS; returns False where that isn't possible"""
+    gc.collect()
+    if libc is not None:
+        # Hand memory freed by earlier stages back to the OS so it doesn't count here
+        libc.malloc_trim(0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(measured, items_per_run=1):
+    """Latency percentiles in milliseconds, throughput in items per second and peak RSS in MB"""
+    timings, peak_mb = measured
+    return {
+        "runs": len(timings),
+        "p50_ms": round(percentile(timings, 50) * 1000, 3),
+        "p90_ms": round(percentile(timings, 90) * 1000, 3),
+        "p99_ms": round(percentile(timings, 99) * 1000, 3),
+        "mean_ms": round(statistics.mean(timings) * 1000, 3),
+        "throughput_per_s": round(items_per_run / statistics.mean(timings), 2) if sum(timings) else None,
+        "peak_rss_mb": peak_mb,
+    }
+
+
+def psnr(a, b):
+    """Peak signal-to-noise ratio between two same-sized images in dB (inf when identical)"""
+    diff = ImageChops.difference(a.convert("RGB"), b.convert("RGB"))
+    mse = statistics.mean(ImageStat.Stat(diff).sum2) / (a.width * a.height)
+    if mse == 0:
+        return float("inf")
+    return round(10 * math.log10(255 ** 2 / mse), 2)
+
+
+def time_it(func, repeat):
+    """Run func repeat times; returns the timings and the peak RSS during them (None if it can't be isolated)"""
+    isolated = reset_peak_rss()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings, peak_rss_mb() if isolated else None
+
+
+def encode(img, ext, encoder=crop_engine.DEFAULT_ENCODER):
+    buffer = io.BytesIO()
+    save_format = crop_engine.get_save_format(ext)
+    options = crop_engine.ENCODER_PROFILES[encoder].get(save_format, {})
+    if save_format == "JPEG":
+        img = crop_engine.flatten_alpha(img)
+    img.save(buffer, format=save_format, **options)
+    return buffer.getbuffer().nbytes
+
+
+def bench_sample(path, preset_name, repeat, out_dir):
+    """Time each stage for one sample image and preset"""
+    preset = PRESETS[preset_name]
+    ext = os.path.splitext(path)[1]
+    results = {}
+
+    def decode_full():
+        with ImageSource(path) as src:
+            src.image.load()
+
+    def decode_draft():
+        with ImageSource(path) as src:
+            img = src.image
+            if preset["size"]:
+                crop_engine.draft_for_target(img, crop_engine.compute_crop_box(img.size, preset), preset["size"])
+            img.load()
+
+    results["decode"] = summarize(time_it(decode_full, repeat))
+    results["decode_draft"] = summarize(time_it(decode_draft, repeat))
+
+    with ImageSource(path) as src:
+        decoded = src.image.copy()
+    box = crop_engine.compute_crop_box(decoded.size, preset)
+    results["crop"] = summarize(time_it(lambda: decoded.crop(box).load(), repeat))
+    if crop_saliency.available():
+        results["smart_crop"] = summarize(time_it(lambda: crop_saliency.saliency_box(decoded, box), repeat))
+
+    cropped = decoded.crop(box)
+    target = preset["size"] or cropped.size
+    results["resize"] = summarize(time_it(lambda: cropped.resize(target, Image.LANCZOS), repeat))
+
+    resized = cropped.resize(target, Image.LANCZOS)
+    if preset["size"]:
+        results["crop_resize_first"] = summarize(time_it(
+            lambda: crop_engine.resize_region(decoded, box, target), repeat))
+        results["crop_resize_first"]["psnr_db"] = psnr(crop_engine.resize_region(decoded, box, target), resized)
+    sizes = []
+    results["encode"] = summarize(time_it(lambda: sizes.append(encode(resized, ext)), repeat))
+    results["encode"]["bytes"] = sizes[-1]
+    for encoder in crop_engine.ENCODER_PROFILES:
+        if encoder != crop_engine.DEFAULT_ENCODER:
+            sizes = []
+            stage = f"encode_{encoder}"
+            results[stage] = summarize(time_it(lambda: sizes.append(encode(resized, ext, encoder)), repeat))
+            results[stage]["bytes"] = sizes[-1]
+
+    if crop_engine.should_split_image(decoded.size, preset):
+        num_panels = crop_engine.get_max_possible_panels(decoded.size, preset)
+
+        def split():
+            for panel in crop_engine.split_to_panels(decoded, preset, num_panels):
+                panel.resize(target, Image.LANCZOS)
+
+        results["split"] = summarize(time_it(split, repeat), num_panels)
+        results["split"]["panels"] = num_panels
+        if crop_saliency.available():
+            boxes = crop_engine.compute_panel_boxes(decoded.size, preset, num_panels)
+            results["smart_split"] = summarize(time_it(
+                lambda: crop_saliency.seam_panel_boxes(decoded, boxes), repeat))
+
+        boxes = crop_engine.compute_panel_boxes(decoded.size, preset, num_panels)
+        if crop_engine.spans_image(decoded, boxes):
+            results["split_resize_first"] = summarize(time_it(
+                lambda: crop_engine.resize_panels(decoded, boxes, target), repeat), num_panels)
+            per_panel = [decoded.crop(b).resize(target, Image.LANCZOS) for b in boxes]
+            span_panels = crop_engine.resize_panels(decoded, boxes, target)
+            results["split_resize_first"]["psnr_db"] = min(psnr(a, b) for a, b in zip(span_panels, per_panel))
+
+    proxy = decoded.copy()
+    proxy.thumbnail((3840, 3840), Image.LANCZOS, reducing_gap=crop_engine.DECODE_REDUCING_GAP)
+
+    def preview():
+        img = crop_engine.crop_to_preset(proxy, preset)
+        ratio = min(PREVIEW_CANVAS[0] / img.width, PREVIEW_CANVAS[1] / img.height)
+        img.resize((max(int(img.width * ratio), 1), max(int(img.height * ratio), 1)), Image.LANCZOS,
+                   reducing_gap=crop_engine.DECODE_REDUCING_GAP)
+
+    results["preview"] = summarize(time_it(preview, repeat))
+
+    def preview_fast():
+        # First pass the GUI shows while the LANCZOS render runs on its preview thread
+        img = crop_engine.crop_to_preset(proxy, preset)
+        ratio = min(PREVIEW_CANVAS[0] / img.width, PREVIEW_CANVAS[1] / img.height)
+        img.resize((max(int(img.width * ratio), 1), max(int(img.height * ratio), 1)), Image.NEAREST)
+
+    results["preview_fast"] = summarize(time_it(preview_fast, repeat))
+
+    engine = CropEngine(preset_name, split_wide_images=True, split_panels=crop_engine.MAX_PANELS)
+    results["end_to_end"] = summarize(time_it(lambda: engine.process(path, out_dir), repeat))
+    return results
+
+
+def compare(current, baseline, threshold=REGRESSION_THRESHOLD):
+    """Return (key, metric, before, after) for stages whose p50 or peak RSS grew by more than threshold"""
+    regressions = []
+    for sample, presets in current["results"].items():
+        for preset, stages in presets.items():
+            for stage, stats in stages.items():
+                before = baseline.get("results", {}).get(sample, {}).get(preset, {}).get(stage)
+                if not isinstance(before, dict):
+                    continue
+                for metric, minimum in (("p50_ms", REGRESSION_MIN_MS), ("peak_rss_mb", REGRESSION_MIN_MB)):
+                    if not before.get(metric) or stats.get(metric) is None:
+                        continue
+                    grown = stats[metric] - before[metric]
+                    if grown > before[metric] * threshold and grown >= minimum:
+                        regressions.append((f"{sample}/{preset}/{stage}", metric, before[metric], stats[metric]))
+    return regressions
+
+
+def bench_isolated(path, preset_name, repeat, out_dir):
+    """bench_sample plus the peak RSS of the whole run; meant for a fresh process"""
+    results = bench_sample(path, preset_name, repeat, out_dir)
+    if resource is not None:
+        # The reset above doesn't touch ru_maxrss, so this covers every stage
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_mb = round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+    else:
+        peak_mb = None
+    results["all_stages"] = {"peak_rss_mb": peak_mb}
+    return results
+
+
+def run_benchmarks(paths, args, out_dir):
+    results = {}
+    for sample in args.samples:
+        results[sample] = {}
+        for preset_name in args.presets:
+            print(f"Benchmarking {sample} / {preset_name}...", file=sys.stderr)
+            # A fresh process per run, so memory held by earlier samples doesn't count
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                results[sample][preset_name] = pool.submit(
+                    bench_isolated, paths[sample], preset_name, args.repeat, out_dir).result()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per stage (default: 5)")
+    parser.add_argument("--scale", type=float, default=1.0, help="scale factor for sample sizes (default: 1.0)")
+    parser.add_argument("--samples", nargs="+", choices=list(SAMPLES), default=list(SAMPLES))
+    parser.add_argument("--presets", nargs="+", choices=list(PRESETS), default=list(PRESETS))
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions (exit code 1 if any)")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="instagram_crop_bench_")
+    try:
+        out_dir = os.path.join(work_dir, "out")
+        os.makedirs(out_dir)
+        paths = write_samples(work_dir, args.scale)
+
+        results = run_benchmarks(paths, args, out_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "scale": args.scale,
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline)
+        for key, metric, before, after in regressions:
+            if metric == "p50_ms":
+                print(f"REGRESSION {key}: p50 {before:.1f} ms -> {after:.1f} ms", file=sys.stderr)
+            else:
+                print(f"REGRESSION {key}: peak RSS {before:.1f} MB -> {after:.1f} MB", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+"""Parallel batch runner built on the headless crop engine.
+
+Files are spread over a process pool. When a batch has fewer files than
+workers (for example one huge panorama), the spare cores resize and encode
+the carousel panels of each split image on threads, so the image is still
+decoded only once. Results are always reported in input order, one
+CropResult per file. With an OutputCache, files whose outputs are already
+cached are restored without being decoded and only the rest reach the pool.
+"""
+import collections
+import copy
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from crop_engine import STAGES, CropResult, format_timings
+
+logger = logging.getLogger("instagram_crop.batch")
+
+
+# Header reads are I/O bound, so planning uses more threads than there are cores
+PLAN_THREADS = 16
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def run_task(engine, output_dir, filename):
+    """Worker entry point; must stay importable at module level for pickling"""
+    return engine.process(filename, output_dir)
+
+
+class BatchPlan:
+    """Header-only plan for a batch: what every file will produce before any decoding"""
+
+    def __init__(self, engine, items):
+        self.engine = engine
+        self.items = items
+
+    @property
+    def total(self):
+        return len(self.items)
+
+    @property
+    def accepted(self):
+        return [item for item in self.items if item.ok]
+
+    @property
+    def rejected(self):
+        return [item for item in self.items if not item.ok]
+
+    @property
+    def total_outputs(self):
+        return sum(item.outputs for item in self.items)
+
+    @property
+    def split_count(self):
+        return sum(1 for item in self.items if item.num_panels)
+
+    @property
+    def estimated_bytes(self):
+        return sum(item.estimated_bytes for item in self.items)
+
+    def to_dict(self):
+        return {
+            "preset": self.engine.preset_name,
+            "total": self.total,
+            "accepted": len(self.accepted),
+            "rejected": len(self.rejected),
+            "split": self.split_count,
+            "total_outputs": self.total_outputs,
+            "estimated_bytes": self.estimated_bytes,
+            "items": [item.to_dict() for item in self.items],
+        }
+
+
+def plan_batch(engine, filenames, max_pixels=None, threads=PLAN_THREADS):
+    """Read only the headers of filenames and return a BatchPlan"""
+    filenames = list(filenames)
+    if len(filenames) <= 1:
+        items = [engine.plan(filename, max_pixels=max_pixels) for filename in filenames]
+    else:
+        with ThreadPoolExecutor(max_workers=min(threads, len(filenames))) as pool:
+            items = list(pool.map(lambda filename: engine.plan(filename, max_pixels=max_pixels), filenames))
+    reject_duplicate_outputs(items)
+    return BatchPlan(engine, items)
+
+
+def reject_duplicate_outputs(items):
+    """Flag plans whose outputs would overwrite those of an earlier file in the batch
+
+    Outputs all land in one directory, so a.jpg from two scanned folders
+    would otherwise silently replace each other.
+    """
+    owners = {}
+    for item in items:
+        if not item.ok:
+            continue
+        names = [os.path.normcase(output_name) for output_name in item.output_names]
+        taken = next((owners[output_name] for output_name in names if output_name in owners), None)
+        if taken is not None:
+            item.error = f"Output name clashes with {taken}"
+            continue
+        for output_name in names:
+            owners[output_name] = item.source
+
+
+class BatchSummary:
+    """Counters matching the ones shown by the GUI after a batch, plus timing totals"""
+
+    def __init__(self, total):
+        self.total = total
+        self.processed = 0
+        self.failed = 0
+        self.total_images = 0  # Total including split panels
+        self.results = []
+        self.elapsed = 0.0  # Wall time of the whole batch, set by whoever ran it
+
+    def add(self, result):
+        self.results.append(result)
+        if result.ok:
+            self.processed += 1
+            self.total_images += len(result.output_paths)
+        else:
+            self.failed += 1
+
+    @property
+    def cached(self):
+        return sum(1 for result in self.results if result.cached)
+
+    @property
+    def throughput(self):
+        """Files finished per second of wall time"""
+        return len(self.results) / self.elapsed if self.elapsed else 0.0
+
+    def stage_totals(self):
+        """Seconds spent in each stage, summed over all files (and worker processes)"""
+        totals = {}
+        for result in self.results:
+            for stage, seconds in result.timings.items():
+                totals[stage] = totals.get(stage, 0.0) + seconds
+        return {stage: totals[stage] for stage in STAGES if stage in totals}
+
+    def slowest(self, count=5):
+        return sorted(self.results, key=lambda result: result.elapsed, reverse=True)[:count]
+
+    def to_dict(self):
+        return {
+            "elapsed": round(self.elapsed, 3),
+            "throughput_per_s": round(self.throughput, 2),
+            "stage_totals": {stage: round(seconds, 3) for stage, seconds in self.stage_totals().items()},
+            "slowest": [{"source": result.source, "elapsed": round(result.elapsed, 3)}
+                        for result in self.slowest()],
+        }
+
+
+def log_summary(summary, log=logger):
+    """Log throughput, where the time went and the slowest files of a finished batch"""
+    log.info("Processed %d/%d files (%d failed, %d from cache, %d outputs) in %.1fs, %.2f files/s",
+             summary.processed, summary.total, summary.failed, summary.cached, summary.total_images,
+             summary.elapsed, summary.throughput)
+    totals = summary.stage_totals()
+    if totals:
+        log.info("Time per stage (all workers): %s", format_timings(totals))
+    for result in summary.slowest():
+        if result.elapsed:
+            log.info("Slow: %s %.1fms (%s)", result.source, result.elapsed * 1000, format_timings(result.timings))
+
+
+class BatchRunner:
+    """Run a CropEngine over many files, optionally on a process pool"""
+
+    def __init__(self, engine, workers=None, cache=None):
+        self.engine = engine
+        self.workers = max(1, workers or default_workers())
+        self.cache = cache
+
+    def worker_engine(self, file_count):
+        """Engine sent to the workers, with panel threads for cores files alone can't fill"""
+        if not self.engine.split_wide_images or file_count >= self.workers:
+            return self.engine
+        engine = copy.copy(self.engine)
+        engine.panel_threads = math.ceil(self.workers / max(file_count, 1))
+        return engine
+
+    def iter_results(self, filenames, output_dir, cancel_event=None, plan=None):
+        """Yield (index, CropResult) for each file in input order.
+
+        Setting cancel_event (a threading.Event) stops the batch early; work
+        that is already running finishes but is not reported. Files rejected
+        by plan (a BatchPlan for the same filenames) are reported as failures
+        without being decoded, and cache hits are restored from the cache.
+        """
+        filenames = list(filenames)
+        # Results known without running the engine, reported in order with the rest
+        ready = {}
+        if plan is not None:
+            ready = {index: CropResult(item.source, error=item.error)
+                     for index, item in enumerate(plan.items) if not item.ok}
+        try:
+            if self.cache is not None:
+                for index, filename in enumerate(filenames):
+                    if index in ready:
+                        continue
+                    output_paths = self.cache.lookup(filename, output_dir, self.engine)
+                    if output_paths is not None:
+                        ready[index] = CropResult(filename, output_paths, split=len(output_paths) > 1, cached=True)
+            todo = [(index, filename) for index, filename in enumerate(filenames) if index not in ready]
+
+            def flush_ready(up_to):
+                for index in sorted(i for i in ready if i < up_to):
+                    yield index, ready.pop(index)
+
+            for index, result in self._iter_todo(todo, output_dir, cancel_event):
+                if self.cache is not None and result.ok:
+                    self.cache.store(filenames[index], result.output_paths, self.engine)
+                yield from flush_ready(index)
+                yield index, result
+            if cancel_event is None or not cancel_event.is_set():
+                yield from flush_ready(len(filenames))
+        finally:
+            if self.cache is not None:
+                self.cache.save()
+
+    def _iter_todo(self, todo, output_dir, cancel_event):
+        engine = self.worker_engine(len(todo))
+        if self.workers == 1 or len(todo) <= 1:
+            for index, filename in todo:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                yield index, engine.process(filename, output_dir)
+            return
+
+        tasks = iter(todo)
+        # Keep a bounded number of tasks in flight so ordered reporting
+        # doesn't buffer the whole batch
+        window = self.workers * 4
+        in_flight = collections.deque()
+
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(todo))) as pool:
+            def fill():
+                while len(in_flight) < window:
+                    task = next(tasks, None)
+                    if task is None:
+                        return
+                    index, filename = task
+                    in_flight.append((index, filename, pool.submit(run_task, engine, output_dir, filename)))
+
+            fill()
+            while in_flight:
+                if cancel_event is not None and cancel_event.is_set():
+                    for _, _, future in in_flight:
+                        future.cancel()
+                    return
+                index, filename, future = in_flight.popleft()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # Worker crashed or the result could not be pickled
+                    logger.error("Worker failed on %s: %s", filename, e)
+                    result = CropResult(filename, error=str(e))
+                fill()
+                yield index, result
+
+    def run(self, filenames, output_dir, on_result=None, cancel_event=None, plan=None):
+        """Process all files and return a BatchSummary.
+
+        on_result(index, result) is called for each file in input order.
+        """
+        filenames = list(filenames)
+        summary = BatchSummary(len(filenames))
+        start = time.perf_counter()
+        for index, result in self.iter_results(filenames, output_dir, cancel_event, plan):
+            summary.add(result)
+            if on_result:
+                on_result(index, result)
+        summary.elapsed = time.perf_counter() - start
+        log_summary(summary)
+        return summary
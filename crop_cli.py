@@ -0,0 +1,343 @@
+"""Command-line batch mode for the Instagram Crop Tool.
+
+Examples:
+    python instagram_crop.py shoot/ -o out/ --preset feed
+    python instagram_crop.py "shoot/**/*.jpg" -o out/ --split --panels 3
+    find shoot -name '*.jpg' | python instagram_crop.py - -o out/ --json
+    python instagram_crop.py hotfolder/ -o out/ --watch
+"""
+import argparse
+import contextlib
+import glob
+import json
+import logging
+import os
+import sys
+
+import crop_saliency
+from crop_batch import BatchRunner, plan_batch
+from crop_watch import DEFAULT_POLL_INTERVAL, DEFAULT_SETTLE_SECONDS, FolderWatcher
+from crop_engine import (PRESETS, DEFAULT_PRESET, DEFAULT_ENCODER, ENCODER_PROFILES, MIN_PANELS, MAX_PANELS,
+                         CropEngine, format_timings, is_image_file, iter_directory)
+from output_cache import DEFAULT_MAX_BYTES, OutputCache, default_cache_dir
+
+# Short names accepted by --preset in addition to the full preset names
+PRESET_ALIASES = {
+    "feed": "Feed (4:5)",
+    "grid": "Grid Feed (3:4)",
+    "reels": "Reels (9:16)",
+}
+
+logger = logging.getLogger("instagram_crop.cli")
+
+# Exit codes
+EXIT_OK = 0
+EXIT_FAILURES = 1
+EXIT_USAGE = 2
+
+
+def resolve_preset(value):
+    """Accept either a full preset name or one of PRESET_ALIASES"""
+    if value in PRESETS:
+        return value
+    alias = PRESET_ALIASES.get(value.lower())
+    if alias:
+        return alias
+    choices = ", ".join(list(PRESET_ALIASES) + [f'"{name}"' for name in PRESETS])
+    raise argparse.ArgumentTypeError(f"unknown preset {value!r} (choose from {choices})")
+
+
+# Units accepted by --max-size (decimal, as upload limits are usually quoted)
+SIZE_UNITS = {"": 1, "b": 1, "k": 1000, "kb": 1000, "m": 1000 ** 2, "mb": 1000 ** 2}
+
+
+def parse_size(value):
+    """Parse a byte size such as 1600000, 800KB or 1.6MB"""
+    text = value.strip().lower()
+    number = text.rstrip("kmb")
+    unit = text[len(number):]
+    try:
+        size = int(float(number) * SIZE_UNITS[unit])
+    except (KeyError, ValueError):
+        raise argparse.ArgumentTypeError(f"invalid size {value!r} (use e.g. 1600000, 800KB or 1.6MB)")
+    if size <= 0:
+        raise argparse.ArgumentTypeError("size must be positive")
+    return size
+
+
+def collect_inputs(inputs, recursive=False, stdin=None):
+    """Expand directories, globs and "-" (file list on stdin) into image paths.
+
+    Explicit file arguments are kept even if their extension is unusual;
+    directory and glob expansions only pick up IMAGE_EXTENSIONS. Duplicates
+    are dropped while keeping the first occurrence's order.
+    """
+    paths = []
+    missing = []
+    for item in inputs:
+        if item == "-":
+            stream = stdin or sys.stdin
+            paths.extend(line.strip() for line in stream if line.strip())
+        elif os.path.isdir(item):
+            paths.extend(iter_directory(item, recursive))
+        elif os.path.isfile(item):
+            paths.append(item)
+        elif glob.has_magic(item):
+            matches = sorted(glob.glob(item, recursive=True))
+            for match in matches:
+                if os.path.isdir(match):
+                    paths.extend(iter_directory(match, recursive))
+                elif is_image_file(match):
+                    paths.append(match)
+        else:
+            missing.append(item)
+
+    seen = set()
+    unique = []
+    for path in paths:
+        key = os.path.abspath(path)
+        if key not in seen:
+            seen.add(key)
+            unique.append(path)
+    return unique, missing
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="instagram_crop.py",
+        description="Crop or split images to Instagram formats without the GUI.")
+    parser.add_argument("inputs", nargs="+",
+                        help="image files, directories or glob patterns; use - to read a file list from stdin")
+    parser.add_argument("-o", "--output", help="output directory (created if missing)")
+    parser.add_argument("-p", "--preset", type=resolve_preset, default=DEFAULT_PRESET,
+                        help="feed, grid, reels or a full preset name (default: feed)")
+    parser.add_argument("-r", "--recursive", action="store_true", help="descend into sub-directories")
+    parser.add_argument("--split", action="store_true", help="split wide images into carousel panels")
+    parser.add_argument("--panels", type=int, default=3, choices=range(MIN_PANELS, MAX_PANELS + 1),
+                        help="number of panels when splitting (default: 3)")
+    parser.add_argument("--encoder", choices=list(ENCODER_PROFILES), default=DEFAULT_ENCODER,
+                        help="encoder settings: default (JPEG quality 95), fast (quick drafts) or "
+                             "upload-size (smaller files, slower encoding) (default: %(default)s)")
+    parser.add_argument("--max-size", type=parse_size, default=None,
+                        help="maximum size of each JPEG/WEBP output, e.g. 1.6MB; the highest quality "
+                             "that fits is chosen")
+    parser.add_argument("--fsync", action="store_true",
+                        help="flush every output to disk before moving on (slower, survives power loss)")
+    parser.add_argument("--full-decode", action="store_true",
+                        help="always decode at full resolution (disables JPEG draft decoding and reduce())")
+    parser.add_argument("--smart-crop", action="store_true",
+                        help="move the crop toward the most detailed part of the image instead of centering it "
+                             "(needs NumPy)")
+    parser.add_argument("--smart-split", action="store_true",
+                        help="move split panel borders off faces, text and other detail, within 15%% of a "
+                             "panel width (needs NumPy)")
+    parser.add_argument("--ignore-overrides", action="store_true",
+                        help="ignore the per-image crop boxes and panel counts saved from the GUI in each "
+                             "folder's instagram_crop_overrides.json")
+    parser.add_argument("--resize-first", action="store_true",
+                        help="resample the crop, or all split panels together, in a single pass "
+                             "instead of resizing each panel separately")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="read only the crop box or split panels of uncompressed images (TIFF, BMP, PPM, TGA) "
+                             "from a memory map of the file instead of decoding it whole")
+    parser.add_argument("-j", "--workers", type=int, default=0,
+                        help="worker processes (default: 0 = one per CPU core)")
+    parser.add_argument("--max-pixels", type=int, default=None,
+                        help="reject images larger than this many pixels before decoding")
+    parser.add_argument("--plan", action="store_true",
+                        help="only read image headers and print what would be produced (no output written)")
+    parser.add_argument("--cache-dir", default=default_cache_dir(),
+                        help="where finished outputs are cached for re-runs (default: %(default)s)")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help="cache size limit in MB (default: %(default)s)")
+    parser.add_argument("--cache-hash", action="store_true",
+                        help="recognise unchanged inputs by content hash instead of size and modification time")
+    parser.add_argument("--no-cache", action="store_true", help="always render every input")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and crop new or modified images in the input directory as they arrive")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE_SECONDS,
+                        help="with --watch, seconds a file must stay unchanged before it is processed "
+                             "(default: %(default)s)")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="with --watch, seconds between rescans when inotify is not available "
+                             "(default: %(default)s)")
+    parser.add_argument("--polling", action="store_true", help="with --watch, rescan instead of using inotify")
+    parser.add_argument("--state", help="with --watch, file recording processed inputs "
+                                        "(default: .instagram_crop_watch.json in the output directory)")
+    parser.add_argument("--json", action="store_true", help="print a JSON summary to stdout")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="log every file with its crop box and per-stage timings")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only log warnings and errors")
+    return parser
+
+
+def setup_logging(args):
+    """Send log records to stderr at the level chosen by -v/-q"""
+    level = logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s" if args.verbose
+                        else "%(levelname)s: %(message)s")
+    # Only our own loggers get chattier; Pillow's debug output is not useful here
+    logging.getLogger("instagram_crop").setLevel(level)
+
+
+def make_engine(args):
+    return CropEngine(args.preset, split_wide_images=args.split, split_panels=args.panels,
+                      fast_decode=not args.full_decode, low_memory=args.low_memory,
+                      resize_first=args.resize_first, encoder=args.encoder, max_bytes=args.max_size,
+                      fsync=args.fsync, smart_crop=args.smart_crop,
+                      smart_split=args.smart_split, overrides=not args.ignore_overrides)
+
+
+def run_plan(args, stdin=None):
+    """Build the header-only plan for the inputs and return it as a summary dict"""
+    filenames, missing = collect_inputs(args.inputs, args.recursive, stdin)
+    plan = plan_batch(make_engine(args), filenames, max_pixels=args.max_pixels)
+    summary = plan.to_dict()
+    summary["missing"] = missing
+    return summary
+
+
+def make_cache(args):
+    if args.no_cache:
+        return None
+    return OutputCache(args.cache_dir, max_bytes=args.cache_size * 1024 * 1024, use_hash=args.cache_hash)
+
+
+def run(args, stdin=None):
+    """Process the inputs described by parsed args and return the summary dict"""
+    filenames, missing = collect_inputs(args.inputs, args.recursive, stdin)
+    engine = make_engine(args)
+
+    plan = plan_batch(engine, filenames, max_pixels=args.max_pixels)
+    runner = BatchRunner(engine, workers=args.workers, cache=make_cache(args))
+    batch = runner.run(filenames, args.output, plan=plan)
+
+    return {
+        "preset": args.preset,
+        "output_dir": os.path.abspath(args.output),
+        "total": batch.total,
+        "processed": batch.processed,
+        "failed": batch.failed,
+        "total_images": batch.total_images,
+        "cached": sum(1 for result in batch.results if result.cached),
+        "planned_outputs": plan.total_outputs,
+        "estimated_bytes": plan.estimated_bytes,
+        "missing": missing,
+        "timing": batch.to_dict(),
+        "results": [
+            {"source": result.source, "outputs": result.output_paths, "error": result.error,
+             "cached": result.cached, "elapsed": round(result.elapsed, 4),
+             "timings": {stage: round(seconds, 4) for stage, seconds in result.timings.items()}}
+            for result in batch.results
+        ],
+    }
+
+
+def watch(args):
+    """Run the hot-folder watcher until interrupted"""
+    if len(args.inputs) != 1 or not os.path.isdir(args.inputs[0]):
+        print("--watch needs exactly one input directory", file=sys.stderr)
+        return EXIT_USAGE
+    if os.path.realpath(args.output) == os.path.realpath(args.inputs[0]):
+        # Every output would be picked up as a new input, without end
+        print("--watch needs an output directory other than the watched one", file=sys.stderr)
+        return EXIT_USAGE
+
+    def report(result):
+        if not result.ok:
+            logger.error("FAILED %s: %s", result.source, result.error)
+        elif result.cached:
+            logger.info("%s -> %d outputs (from cache)", result.source, len(result.output_paths))
+        else:
+            logger.info("%s -> %d outputs in %.1fms (%s)", result.source, len(result.output_paths),
+                        result.elapsed * 1000, format_timings(result.timings))
+
+    watcher = FolderWatcher(make_engine(args), args.inputs[0], args.output, state_path=args.state,
+                            workers=args.workers, recursive=args.recursive, settle=args.settle,
+                            interval=args.poll_interval, use_polling=args.polling, cache=make_cache(args),
+                            on_result=report)
+    logger.info("Watching %s (Ctrl+C to stop)", os.path.abspath(args.inputs[0]))
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return EXIT_OK
+
+
+def print_plan(args, stdin=None):
+    with contextlib.redirect_stdout(sys.stderr):
+        summary = run_plan(args, stdin)
+
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        for item in summary["items"]:
+            if item["error"]:
+                print(f"REJECTED {item['source']}: {item['error']}")
+            elif item["split"]:
+                print(f"{item['source']}: {item['size'][0]}x{item['size'][1]} -> split into {item['split']} panels")
+            else:
+                print(f"{item['source']}: {item['size'][0]}x{item['size'][1]} -> crop {tuple(item['boxes'][0])}")
+        print(f"{summary['total']} images, {summary['rejected']} rejected, {summary['split']} split, "
+              f"{summary['total_outputs']} outputs, ~{summary['estimated_bytes'] / 1e6:.1f} MB")
+
+    for item in summary["missing"]:
+        print(f"No such file or directory: {item}", file=sys.stderr)
+
+    if summary["total"] == 0:
+        print("No input images found", file=sys.stderr)
+        return EXIT_USAGE
+    return EXIT_FAILURES if summary["rejected"] or summary["missing"] else EXIT_OK
+
+
+def main(argv=None, stdin=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    setup_logging(args)
+    if args.smart_crop and not crop_saliency.available():
+        parser.error("--smart-crop needs NumPy (pip install numpy)")
+    if args.smart_split and not crop_saliency.available():
+        parser.error("--smart-split needs NumPy (pip install numpy)")
+
+    if args.plan:
+        return print_plan(args, stdin)
+    if not args.output:
+        parser.error("the following arguments are required: -o/--output")
+
+    try:
+        os.makedirs(args.output, exist_ok=True)
+    except OSError as e:
+        parser.error(f"cannot create output directory: {e}")
+    if not os.access(args.output, os.W_OK):
+        parser.error(f"cannot write to the output directory: {args.output}")
+
+    if args.watch:
+        return watch(args)
+
+    # Keep stdout clean for the machine-readable summary
+    with contextlib.redirect_stdout(sys.stderr):
+        summary = run(args, stdin)
+
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        for result in summary["results"]:
+            if result["error"]:
+                print(f"FAILED {result['source']}: {result['error']}", file=sys.stderr)
+        print(f"Processed {summary['processed']}/{summary['total']} images ({summary['cached']} from cache), "
+              f"{summary['failed']} failed, {summary['total_images']} outputs written to {summary['output_dir']}")
+
+    for item in summary["missing"]:
+        print(f"No such file or directory: {item}", file=sys.stderr)
+
+    if summary["total"] == 0:
+        print("No input images found", file=sys.stderr)
+        return EXIT_USAGE
+    return EXIT_FAILURES if summary["failed"] or summary["missing"] else EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
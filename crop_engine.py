@@ -0,0 +1,1000 @@
+"""Headless crop/split engine shared by the GUI and the batch tools.
+
+Nothing in here touches Tk, so it can run on servers without a display.
+Failures are raised as CropError (or reported on a CropResult) instead of
+being shown in message boxes, and diagnostics go to the
+"instagram_crop.engine" logger.
+"""
+import contextlib
+import io
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+import crop_saliency
+import raster_io
+from crop_manifest import ManifestSet
+
+logger = logging.getLogger("instagram_crop.engine")
+
+# Presets for Instagram
+PRESETS = {
+    "Feed (4:5)": {"ratio": (4, 5), "size": (1080, 1350)},
+    "Grid Feed (3:4)": {"ratio": (3, 4), "size": (354, 472)},
+    "Reels (9:16)": {"ratio": (9, 16), "size": None}
+}
+
+DEFAULT_PRESET = "Feed (4:5)"
+
+# Extensions picked up when scanning folders (matches the GUI file dialogs).
+# The uncompressed ones are scanner masters that --low-memory reads in place.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.tif', '.tiff', '.bmp', '.ppm', '.pgm', '.tga')
+
+# Input formats Instagram doesn't take; their outputs are written as PNG
+PNG_OUTPUT_FORMATS = ('TIF', 'TIFF', 'PPM', 'PGM', 'TGA')
+
+# Panel counts offered for carousel splits
+MIN_PANELS = 2
+MAX_PANELS = 5
+
+# Cheap downscaling (JPEG DCT scaling, reduce()) stops once the region is
+# within this factor of the target size; LANCZOS does the rest. Same idea as
+# Pillow's reducing_gap, and it guarantees we never go below the preset size.
+DECODE_REDUCING_GAP = 2.0
+
+# Rough encoded size per output pixel, used to estimate batch output size
+ESTIMATED_BYTES_PER_PIXEL = {
+    'JPEG': 0.45,
+    'WEBP': 0.3,
+    'PNG': 2.0,
+    'GIF': 1.0,
+    'BMP': 3.0,
+}
+
+# Save options per output format for each encoder profile. "default" is what
+# the tool has always written; "fast" is for drafts, and "upload-size" spends
+# encoder time on smaller files since Instagram recompresses uploads anyway.
+ENCODER_PROFILES = {
+    "default": {
+        'JPEG': {"quality": 95},
+        'PNG': {},
+        'WEBP': {},
+    },
+    "fast": {
+        'JPEG': {"quality": 85, "subsampling": "4:2:0"},
+        'PNG': {"compress_level": 1},
+        'WEBP': {"quality": 80, "method": 0},
+    },
+    "upload-size": {
+        'JPEG': {"quality": 85, "subsampling": "4:2:0", "optimize": True, "progressive": True},
+        'PNG': {"compress_level": 9},
+        'WEBP': {"quality": 80, "method": 6},
+    },
+}
+
+DEFAULT_ENCODER = "default"
+
+# Quality search bounds for outputs with a maximum file size. Eight attempts
+# cover a full binary search between the two.
+MAX_TARGET_QUALITY = 95
+MIN_TARGET_QUALITY = 20
+MAX_TARGET_ATTEMPTS = 8
+
+# Formats whose size can be tuned through the quality setting
+SIZE_TARGET_FORMATS = ('JPEG', 'WEBP')
+
+# Modes Image.reduce() averages correctly (palette images must not be averaged)
+REDUCE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK')
+
+
+class CropError(Exception):
+    """Raised when an image cannot be cropped, split or saved"""
+
+
+# Stages timed for every processed item, in pipeline order
+STAGES = ("open", "decode", "crop", "resize", "encode", "write")
+
+
+def format_timings(timings):
+    """Render stage timings as "open=1.2ms decode=30.5ms ..." for log lines"""
+    return " ".join(f"{stage}={timings[stage] * 1000:.1f}ms" for stage in STAGES if stage in timings)
+
+
+class StageTimer:
+    """Wall time per processing stage (open, decode, crop, resize, encode, write) for one item.
+
+    Split panels processed on threads add up, so stage totals can exceed the
+    item's elapsed time.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+
+def format_name(preset_name):
+    """Turn a preset name into the tag used in output filenames (e.g. Feed4-5)"""
+    return preset_name.replace(" ", "").replace("(", "").replace(")", "").replace(":", "-")
+
+
+def is_image_file(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_directory(path, recursive):
+    """Yield image files in a directory in sorted order"""
+    if recursive:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if is_image_file(filename):
+                    yield os.path.join(dirpath, filename)
+    else:
+        for filename in sorted(os.listdir(path)):
+            full_path = os.path.join(path, filename)
+            if os.path.isfile(full_path) and is_image_file(filename):
+                yield full_path
+
+
+def get_save_format(ext):
+    """Map a file extension to the Pillow format name used when saving"""
+    save_format = ext.lower().replace('.', '')
+    if save_format in ('jpg', 'jpeg'):
+        return 'JPEG'
+    return save_format.upper()
+
+
+def compute_crop_box(size, preset):
+    """Return the centered (left, top, right, bottom) box matching the preset ratio"""
+    width, height = size
+    target_ratio = preset["ratio"][0] / preset["ratio"][1]
+    current_ratio = width / height
+
+    if current_ratio > target_ratio:
+        # Image is wider than target, crop width
+        new_width = int(height * target_ratio)
+        left = (width - new_width) // 2
+        top = 0
+        right = left + new_width
+        bottom = height
+    else:
+        # Image is taller than target, crop height
+        new_height = int(width / target_ratio)
+        left = 0
+        top = (height - new_height) // 2
+        right = width
+        bottom = top + new_height
+
+    return (left, top, right, bottom)
+
+
+def should_split_image(size, preset):
+    """Determine if an image of this size can be split for the preset"""
+    return get_max_possible_panels(size, preset) >= MIN_PANELS
+
+
+def get_max_possible_panels(size, preset):
+    """Calculate how many panels an image of this size can be split into"""
+    if not preset["size"]:
+        return 1
+
+    # Calculate how many standard widths fit into the image
+    panels_possible = size[0] // preset["size"][0]
+
+    # Limit to 5 panels maximum
+    return min(panels_possible, MAX_PANELS)
+
+
+def compute_panel_boxes(size, preset, num_panels):
+    """Return the crop boxes for splitting a wide image into carousel panels"""
+    img_width, img_height = size
+
+    # Get target aspect ratio
+    target_ratio = preset["ratio"][0] / preset["ratio"][1]
+
+    # Determine panel width based on image width
+    panel_width = img_width // num_panels
+
+    # Adjust panel width to match aspect ratio
+    new_height = int(panel_width / target_ratio)
+    if new_height < img_height:
+        # If calculated height is too small, use target aspect ratio instead
+        panel_width = int(img_height * target_ratio)
+
+    # Calculate overlap
+    total_width_needed = panel_width * num_panels
+
+    if total_width_needed <= img_width:
+        # No overlap needed - image is wide enough
+        overlap = 0
+        # Distribute panels evenly across the image
+        spacing = (img_width - total_width_needed) // (num_panels + 1)
+        start_offset = spacing
+    else:
+        # Need overlap - calculate how much
+        overlap_pixels = total_width_needed - img_width
+        overlap = int(overlap_pixels / (num_panels - 1)) if num_panels > 1 else 0
+        start_offset = 0
+
+    boxes = []
+    for i in range(num_panels):
+        # Calculate panel boundaries
+        left = start_offset + (i * (panel_width - overlap))
+
+        # Ensure we don't go out of bounds
+        if left < 0:
+            left = 0
+        if left + panel_width > img_width:
+            left = img_width - panel_width
+
+        right = min(left + panel_width, img_width)
+
+        # Ensure panel has valid dimensions
+        if left >= right:
+            continue
+
+        boxes.append((left, 0, right, img_height))
+
+    return boxes
+
+
+def reduction_factor(box_size, target_size, gap=DECODE_REDUCING_GAP):
+    """Largest integer factor a region can be shrunk by while staying gap times above target"""
+    scale = min(box_size[0] / target_size[0], box_size[1] / target_size[1])
+    return max(1, int(scale / gap))
+
+
+def draft_for_target(img, box, target_size):
+    """Let the JPEG decoder downscale while decoding when box -> target_size allows it.
+
+    Must be called before the image is loaded; it is a no-op for other
+    formats and for images that are already decoded. Returns the scale the
+    decoder will use (1 when nothing changed). img.size shrinks accordingly,
+    so crop boxes have to be recomputed afterwards.
+    """
+    if img.format != "JPEG" or not target_size:
+        return 1
+    factor = reduction_factor((box[2] - box[0], box[3] - box[1]), target_size)
+    if factor < 2:
+        return 1
+    full_width = img.size[0]
+    # The decoder picks the largest DCT scale (1/2, 1/4, 1/8) that keeps the
+    # image at least as big as requested, so it never exceeds factor
+    requested = (math.ceil(img.size[0] / factor), math.ceil(img.size[1] / factor))
+    if img.draft(img.mode, requested) is None:
+        return 1
+    return full_width / img.size[0]
+
+
+def extract_region(img, box, target_size=None):
+    """Crop box out of img, folding an integer reduce() into the crop when the target allows it"""
+    if target_size and img.mode in REDUCE_MODES:
+        factor = reduction_factor((box[2] - box[0], box[3] - box[1]), target_size)
+        if factor >= 2:
+            return img.reduce(factor, box=box)
+    return img.crop(box)
+
+
+def resize_region(img, box, size, reducing_gap=None):
+    """Crop box out of img and resample it to size in one LANCZOS pass"""
+    return img.resize(size, Image.LANCZOS, box=box, reducing_gap=reducing_gap)
+
+
+def spans_image(img, boxes):
+    """True when the panel boxes stay inside img, so they can be resampled as one span.
+
+    Images barely wider than one panel get boxes that reach past the left
+    edge (crop() pads those with black), which resize(box=...) rejects.
+    """
+    return boxes[0][0] >= 0 and boxes[-1][2] <= img.width
+
+
+def resize_panels(img, boxes, size, reducing_gap=None):
+    """Resample the span covered by all panel boxes once, then slice the panels from it.
+
+    The boxes must be full height and equally wide (as from compute_panel_boxes)
+    and lie inside the image; see spans_image(). Returns one image of the
+    given size per box.
+    """
+    span_left, span_right = boxes[0][0], boxes[-1][2]
+    box_width = boxes[0][2] - boxes[0][0]
+    scale_x = size[0] / box_width
+    span_size = (max(size[0], round((span_right - span_left) * scale_x)), size[1])
+    span = resize_region(img, (span_left, 0, span_right, img.size[1]), span_size, reducing_gap)
+
+    panels = []
+    for left, _, _, _ in boxes:
+        offset = min(round((left - span_left) * scale_x), span.width - size[0])
+        panels.append(span.crop((offset, 0, offset + size[0], size[1])))
+    return panels
+
+
+def override_box_fits(box, size, preset):
+    """Whether a stored crop box lies inside an image of this size and has the preset ratio"""
+    left, top, right, bottom = box
+    if not (0 <= left < right <= size[0] and 0 <= top < bottom <= size[1]):
+        return False
+    # Boxes are whole pixels, so allow the rounding compute_crop_box does
+    target_ratio = preset["ratio"][0] / preset["ratio"][1]
+    return abs((right - left) - (bottom - top) * target_ratio) <= max(2, target_ratio)
+
+
+def scale_box(box, from_size, to_size):
+    """Map a box on an image of from_size onto the same image at to_size"""
+    scale_x, scale_y = to_size[0] / from_size[0], to_size[1] / from_size[1]
+    left, top, right, bottom = box
+    return (round(left * scale_x), round(top * scale_y),
+            min(round(right * scale_x), to_size[0]), min(round(bottom * scale_y), to_size[1]))
+
+
+def crop_to_preset(img, preset, smart=False, box=None):
+    """Crop an in-memory image to the preset ratio (no resize), optionally following the subject.
+
+    box, when given, is used as is instead of the centered or smart box.
+    """
+    if box is not None:
+        left, top, right, bottom = box
+        smart = False
+    else:
+        left, top, right, bottom = compute_crop_box(img.size, preset)
+    if smart and left < right and top < bottom:
+        left, top, right, bottom = crop_saliency.saliency_box(img, (left, top, right, bottom))
+    if left >= right or top >= bottom:
+        raise CropError(f"Invalid crop dimensions: ({left}, {top}, {right}, {bottom})")
+    return img.crop((left, top, right, bottom))
+
+
+def split_to_panels(img, preset, num_panels, smart=False):
+    """Split an in-memory image into panels that follow the preset ratio (no resize).
+
+    With smart, panel borders are moved off detailed areas (see crop_saliency.seam_panel_boxes).
+    """
+    boxes = compute_panel_boxes(img.size, preset, num_panels)
+    if smart:
+        boxes = crop_saliency.seam_panel_boxes(img, boxes)
+    panels = []
+    for box in boxes:
+        panel = img.crop(box)
+        if panel.width > 0 and panel.height > 0:
+            panels.append(panel)
+    return panels
+
+
+def flatten_alpha(img):
+    """Composite RGBA/LA images onto white so they can be written as JPEG"""
+    if img.mode not in ('RGBA', 'LA'):
+        return img
+    rgb_img = Image.new("RGB", img.size, (255, 255, 255))
+    rgb_img.paste(img, mask=img.split()[-1])
+    return rgb_img
+
+
+def encode_to_size(img, save_format, options, max_bytes, min_quality=MIN_TARGET_QUALITY,
+                   max_attempts=MAX_TARGET_ATTEMPTS):
+    """Encode img at the highest quality whose output fits in max_bytes.
+
+    Trial encodes go to memory only. The profile's own quality is tried
+    first, so outputs that already fit cost a single encode. Returns
+    (data, quality); raises CropError if even min_quality is too big.
+    """
+    def attempt(quality):
+        return encode_image(img, save_format, dict(options, quality=quality))
+
+    top = options.get("quality", MAX_TARGET_QUALITY)
+    data = attempt(top)
+    if len(data) <= max_bytes:
+        return data, top
+
+    best = None
+    attempts = 1
+    low, high = min_quality, top - 1
+    while low <= high and attempts < max_attempts:
+        quality = (low + high) // 2
+        data = attempt(quality)
+        attempts += 1
+        if len(data) <= max_bytes:
+            best = (data, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    if best is None:
+        raise CropError(f"Cannot encode under {max_bytes} bytes even at quality {min_quality}")
+    return best
+
+
+def encode_image(img, save_format, options):
+    """Encode img into bytes in memory"""
+    buffer = io.BytesIO()
+    img.save(buffer, format=save_format, **options)
+    return buffer.getvalue()
+
+
+def write_atomic(data, path, fsync=False):
+    """Write data to path through a temp file in the same directory and os.replace.
+
+    Readers (and a crash) only ever see the old file or the complete new one.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp_path = os.path.join(directory, f".{name}.{os.urandom(4).hex()}.tmp")
+    # Unlike mkstemp, os.open with 0o666 keeps the usual umask-based permissions
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def fsync_directory(path):
+    """Make renames in a directory durable (no-op where directories can't be opened)"""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_image(img, output_path, backup_path=None, encoder=None, max_bytes=None, fsync=False, timer=None):
+    """Encode an image in the format implied by its extension and write it atomically.
+
+    encoder is one of ENCODER_PROFILES (the default profile when None). With
+    max_bytes, JPEG and WEBP outputs get the highest quality that fits. The
+    encoded bytes are checked in memory, so no partial or empty file is ever
+    left at output_path.
+    Returns the path actually written, which differs from output_path when the
+    extension is unknown or one of PNG_OUTPUT_FORMATS (saved as PNG) or the
+    backup JPEG had to be used.
+    """
+    encoder = encoder or ENCODER_PROFILES[DEFAULT_ENCODER]
+    timer = timer or StageTimer()
+    save_format = get_save_format(os.path.splitext(output_path)[1])
+
+    with timer.stage("encode"):
+        if max_bytes and save_format in SIZE_TARGET_FORMATS:
+            data, quality = encode_to_size(img, save_format, encoder.get(save_format, {}), max_bytes)
+            logger.debug("Encoded %s at quality %d (%d bytes)", output_path, quality, len(data))
+        elif save_format in ['JPEG', 'PNG', 'GIF', 'BMP', 'WEBP']:
+            data = encode_image(img, save_format, encoder.get(save_format, {}))
+            if max_bytes and len(data) > max_bytes:
+                logger.warning("%s output is lossless and cannot be shrunk to %d bytes: %s",
+                               save_format, max_bytes, output_path)
+        else:
+            # Default to PNG if format not recognized
+            if save_format not in PNG_OUTPUT_FORMATS:
+                logger.warning("Unrecognized format: %s, defaulting to PNG", save_format)
+            output_path = os.path.splitext(output_path)[0] + ".png"
+            data = encode_image(img, "PNG", encoder.get('PNG', {}))
+
+        if not data:
+            if not backup_path:
+                raise CropError(f"Encoder produced no data for {output_path}")
+            # Try again as a flattened JPEG under a different name
+            logger.warning("Encoder produced no data for %s, saving backup to: %s", output_path, backup_path)
+            data = encode_image(flatten_alpha(img), "JPEG", encoder.get('JPEG', {}))
+            if not data:
+                raise CropError(f"Encoder produced no data for {backup_path}")
+            output_path = backup_path
+
+    with timer.stage("write"):
+        write_atomic(data, output_path, fsync)
+    return output_path
+
+
+class ImageSource:
+    """One input image for a job: header read once, pixels decoded at most once.
+
+    Wraps a path or an in-memory PIL image. size comes from the header alone
+    and always reports the full-resolution dimensions, even after draft
+    decoding has been requested. image returns the same PIL object every
+    time, so every step of a job shares one file handle and one decode.
+    Images passed in by the caller are never drafted, since that would
+    shrink the caller's object too.
+    """
+
+    def __init__(self, source, name=None):
+        self.path = None
+        self._image = None
+        if isinstance(source, Image.Image):
+            self._image = source
+            name = name or os.path.basename(getattr(source, "filename", "") or "")
+            if not name:
+                raise CropError("A name is required for in-memory images")
+        else:
+            self.path = source
+            name = name or os.path.basename(source)
+        self.name = name
+        self._size = self._image.size if self._image is not None else None
+
+    @property
+    def image(self):
+        if self._image is None:
+            # Image.open only parses the header; pixels are decoded on first use
+            self._image = Image.open(self.path)
+            self._size = self._image.size
+        return self._image
+
+    @property
+    def size(self):
+        if self._size is None:
+            self.image
+        return self._size
+
+    @property
+    def format(self):
+        return self.image.format
+
+    @property
+    def owned(self):
+        """True when the image was opened here from a path, so it may be drafted or closed"""
+        return self.path is not None
+
+    def close(self):
+        """Release the file handle of images this source opened itself"""
+        if self.owned and self._image is not None:
+            self._image.close()
+            self._image = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CropPlan:
+    """What processing one image will produce, worked out from its header alone"""
+
+    def __init__(self, source, size=None, format=None, num_panels=0, boxes=None,
+                 output_size=None, output_names=None, estimated_bytes=0, error=None):
+        self.source = source
+        self.size = size
+        self.format = format
+        self.num_panels = num_panels  # 0 when the image is cropped, not split
+        self.boxes = boxes or []
+        self.output_size = output_size
+        self.output_names = output_names or []
+        self.estimated_bytes = estimated_bytes
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def outputs(self):
+        return len(self.output_names)
+
+    def to_dict(self):
+        return {
+            "source": self.source,
+            "size": list(self.size) if self.size else None,
+            "format": self.format,
+            "split": self.num_panels,
+            "boxes": [list(box) for box in self.boxes],
+            "output_size": list(self.output_size) if self.output_size else None,
+            "outputs": self.output_names,
+            "estimated_bytes": self.estimated_bytes,
+            "error": self.error,
+        }
+
+
+class CropResult:
+    """Outcome of processing one source image"""
+
+    def __init__(self, source, output_paths=None, error=None, split=False, cached=False):
+        self.source = source
+        self.output_paths = output_paths or []
+        self.error = error
+        self.split = split
+        # Outputs were restored from an OutputCache instead of being rendered
+        self.cached = cached
+        # Seconds per stage (see StageTimer) and for the whole item
+        self.timings = {}
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None and len(self.output_paths) > 0
+
+    def __repr__(self):
+        return f"CropResult({self.source!r}, outputs={len(self.output_paths)}, error={self.error!r})"
+
+
+class CropEngine:
+    """Crop or split images for one preset without any GUI state.
+
+    Sources may be a file path or an in-memory PIL image. In-memory images
+    need a name (e.g. "photo.jpg") so output filenames and formats can be
+    derived; it defaults to the image's own filename when it has one.
+    """
+
+    def __init__(self, preset_name=DEFAULT_PRESET, split_wide_images=False, split_panels=3, presets=None,
+                 fast_decode=True, low_memory=False, resize_first=False, encoder=DEFAULT_ENCODER,
+                 max_bytes=None, fsync=False, smart_crop=False, smart_split=False, overrides=True):
+        self.presets = presets or PRESETS
+        if preset_name not in self.presets:
+            raise CropError(f"Unknown preset: {preset_name}")
+        self.preset_name = preset_name
+        self.preset = self.presets[preset_name]
+        self.split_wide_images = bool(split_wide_images)
+        self.split_panels = split_panels
+        # Use JPEG draft decoding and reduce() when the output size allows it
+        self.fast_decode = fast_decode
+        # Threads used to resize/encode the panels of one split image
+        self.panel_threads = 1
+        # Read only the crop box or panels of uncompressed files (memory-mapped
+        # where possible) instead of decoding them whole
+        self.low_memory = low_memory
+        # Resample the crop (or the whole panel span) in one pass before slicing,
+        # instead of cropping at full resolution and resizing each piece
+        self.resize_first = resize_first
+        if encoder not in ENCODER_PROFILES:
+            raise CropError(f"Unknown encoder profile: {encoder}")
+        self.encoder_name = encoder
+        self.encoder = ENCODER_PROFILES[encoder]
+        # Maximum size of each JPEG/WEBP output in bytes; quality is lowered to fit
+        self.max_bytes = max_bytes
+        # fsync each output and, once per input, the output directory
+        self.fsync = fsync
+        # Move the crop window toward the most detailed area instead of centering it
+        if smart_crop and not crop_saliency.available():
+            raise CropError("Smart crop needs NumPy (pip install numpy)")
+        self.smart_crop = smart_crop
+        # Shift split panels so their borders avoid faces, text and other detail
+        if smart_split and not crop_saliency.available():
+            raise CropError("Smart split needs NumPy (pip install numpy)")
+        self.smart_split = smart_split
+        # Per-image crop boxes and panel counts from the sidecar manifest of
+        # each input's folder (see crop_manifest); None when they are ignored
+        self.manifests = ManifestSet() if overrides else None
+
+    def settings_key(self, path=None):
+        """Everything that changes the output bytes for a given input, for cache keys.
+
+        panel_threads is left out: it changes how panels are produced, not
+        what is written. low_memory is too, unless smart split or
+        resize-first is on: streamed panels skip seam planning and the
+        single resample over the panel span. With path, the file's manifest
+        override for this preset is included too.
+        """
+        key = {
+            "preset": self.preset_name,
+            "ratio": self.preset["ratio"],
+            "size": self.preset["size"],
+            "split": self.split_wide_images,
+            "panels": self.split_panels if self.split_wide_images else None,
+            "fast_decode": bool(self.fast_decode),
+            "resize_first": bool(self.resize_first),
+            "encoder": self.encoder,
+            "max_bytes": self.max_bytes,
+            "smart_crop": bool(self.smart_crop),
+            "smart_split": bool(self.smart_split),
+        }
+        if self.smart_split or self.resize_first:
+            key["low_memory"] = bool(self.low_memory)
+        if path is not None and self.manifests is not None:
+            entry = self.manifests.for_image(path).raw_entry(path)
+            if entry:
+                key["override"] = {"size": entry.get("size"), "panels": entry.get("panels"),
+                                   "crop": entry.get("crops", {}).get(self.preset_name)}
+        return key
+
+    def override_for(self, src):
+        """Manifest entry of a file source, or None when there is none for its current size"""
+        if self.manifests is None or src.path is None:
+            return None
+        manifest = self.manifests.for_image(src.path)
+        entry = manifest.entry(src.path, src.size)
+        if entry is None and manifest.raw_entry(src.path):
+            logger.warning("Ignoring crop override for %s: it was made for an image of another size", src.name)
+        return entry
+
+    def _override_box(self, src, override):
+        """Full-resolution crop box the override sets for this preset, or None"""
+        box = override.get("crops", {}).get(self.preset_name) if override else None
+        if not box:
+            return None
+        box = tuple(box)
+        if not override_box_fits(box, src.size, self.preset):
+            logger.warning("Ignoring crop override %s for %s: it doesn't fit the image or the preset ratio",
+                           box, src.name)
+            return None
+        return box
+
+    @contextlib.contextmanager
+    def _opened(self, source, name=None):
+        """Yield an ImageSource, closing it afterwards unless the caller owns it"""
+        if isinstance(source, ImageSource):
+            yield source
+            return
+        src = ImageSource(source, name)
+        try:
+            yield src
+        finally:
+            src.close()
+
+    def _output_base(self, name):
+        base, ext = os.path.splitext(name)
+        tag = format_name(self.preset_name)
+        if get_save_format(ext) in PNG_OUTPUT_FORMATS:
+            # Written as PNG; keep the source extension so pano.tif and pano.ppm don't collide
+            tag = f"{tag}_{ext[1:].lower()}"
+            ext = ".png"
+        return base, ext, tag
+
+    def output_filename(self, name, panel=None, num_panels=None):
+        """Output filename for a source name, e.g. photo_Feed4-5.jpg or photo_Feed4-5_panel1of3.jpg.
+
+        Sources saved as PNG (PNG_OUTPUT_FORMATS) keep their extension in the
+        tag: pano.tif gives pano_Feed4-5_tif.png.
+        """
+        base, ext, tag = self._output_base(name)
+        if panel is None:
+            return f"{base}_{tag}{ext}"
+        return f"{base}_{tag}_panel{panel}of{num_panels}{ext}"
+
+    def crop(self, source, output_dir, name=None):
+        """Crop a single image to the preset and save it. Returns the output path."""
+        with self._opened(source, name) as src:
+            return self._crop(src, output_dir, override=self.override_for(src))
+
+    def _crop(self, src, output_dir, timer=None, override=None):
+        timer = timer or StageTimer()
+        img = src.image
+        target_size = self.preset["size"] if self.fast_decode else None
+        override_box = self._override_box(src, override)
+        full_box = override_box or compute_crop_box(src.size, self.preset)
+
+        if target_size and src.owned:
+            draft_for_target(img, full_box, target_size)
+
+        if override_box:
+            left, top, right, bottom = scale_box(override_box, src.size, img.size)
+        else:
+            left, top, right, bottom = compute_crop_box(img.size, self.preset)
+        if left >= right or top >= bottom:
+            raise CropError(f"Invalid crop dimensions: ({left}, {top}, {right}, {bottom})")
+        # A stored box is used as is; smart crop doesn't move it
+        smart_crop = self.smart_crop and not override_box
+        # In low-memory mode only the crop box of uncompressed sources is read;
+        # smart crop has to look at the whole image
+        strips = raster_io.raw_layout(img) if self.low_memory and src.path and not smart_crop else None
+        if strips:
+            with timer.stage("decode"):
+                mapped = raster_io.map_file(img)
+                try:
+                    region = raster_io.read_region(img, (left, top, right, bottom), strips, mapped=mapped)
+                finally:
+                    if mapped is not None:
+                        mapped.close()
+            logger.debug("Read %s crop box from disk (%s)", src.name, "mmap" if mapped is not None else "seek")
+            img = region
+            left, top, right, bottom = 0, 0, region.width, region.height
+        with timer.stage("decode"):
+            img.load()
+        if smart_crop:
+            with timer.stage("crop"):
+                left, top, right, bottom = crop_saliency.saliency_box(img, (left, top, right, bottom))
+
+        if self.resize_first and self.preset["size"]:
+            with timer.stage("resize"):
+                cropped_img = resize_region(img, (left, top, right, bottom), self.preset["size"],
+                                            DECODE_REDUCING_GAP if self.fast_decode else None)
+        else:
+            with timer.stage("crop"):
+                cropped_img = extract_region(img, (left, top, right, bottom), target_size)
+
+            # Resize if size is specified
+            if self.preset["size"]:
+                with timer.stage("resize"):
+                    cropped_img = cropped_img.resize(self.preset["size"], Image.LANCZOS)
+        logger.debug("Cropped %s: %dx%d box (%d, %d, %d, %d) -> %dx%d", src.name, img.width, img.height,
+                     left, top, right, bottom, cropped_img.width, cropped_img.height)
+
+        base = os.path.splitext(src.name)[0]
+        output_path = os.path.join(output_dir, self.output_filename(src.name))
+        backup_path = os.path.join(output_dir, f"{base}_backup.jpg")
+        return save_image(cropped_img, output_path, backup_path, self.encoder, self.max_bytes, self.fsync, timer)
+
+    def split_count(self, size, override=None):
+        """Return how many panels an image of this size will be split into, or 0 to crop it.
+
+        A panel count from a manifest override (0 to always crop) takes
+        precedence over the engine's split settings.
+        """
+        panels = override.get("panels") if override else None
+        if panels is not None:
+            return panels if MIN_PANELS <= panels <= get_max_possible_panels(size, self.preset) else 0
+        if not self.split_wide_images:
+            return 0
+        max_panels = get_max_possible_panels(size, self.preset)
+        if max_panels >= MIN_PANELS and self.split_panels <= max_panels:
+            return self.split_panels
+        return 0
+
+    def split(self, source, output_dir, num_panels, name=None):
+        """Split a wide image into carousel panels and save them. Returns the output paths."""
+        with self._opened(source, name) as src:
+            return self._split(src, output_dir, num_panels)
+
+    def _split(self, src, output_dir, num_panels, timer=None):
+        # Check if image is wide enough for requested number of panels
+        num_panels = min(num_panels, get_max_possible_panels(src.size, self.preset))
+        if num_panels < MIN_PANELS:
+            raise CropError(f"Image is not wide enough to split: {src.size[0]}px")
+
+        timer = timer or StageTimer()
+        img = src.image
+        target_size = self.preset["size"] if self.fast_decode else None
+        if target_size and src.owned:
+            draft_for_target(img, compute_panel_boxes(img.size, self.preset, num_panels)[0], target_size)
+
+        boxes = compute_panel_boxes(img.size, self.preset, num_panels)
+        base = os.path.splitext(src.name)[0]
+
+        # In low-memory mode, uncompressed sources are read panel by panel
+        # straight from disk instead of decoding the whole image
+        strips = raster_io.raw_layout(img) if self.low_memory and src.path else None
+        mapped = raster_io.map_file(img) if strips else None
+        if not strips:
+            # Decode once here; every panel shares the decoded pixels
+            with timer.stage("decode"):
+                img.load()
+            if self.smart_split:
+                with timer.stage("crop"):
+                    boxes = crop_saliency.seam_panel_boxes(img, boxes)
+        logger.debug("Splitting %s (%dx%d) into %d panels: %s", src.name, img.width, img.height,
+                     len(boxes), boxes)
+
+        resized = None
+        if self.resize_first and self.preset["size"] and not strips and spans_image(img, boxes):
+            # One resample over the panel span instead of one per panel
+            with timer.stage("resize"):
+                resized = resize_panels(img, boxes, self.preset["size"],
+                                        DECODE_REDUCING_GAP if self.fast_decode else None)
+
+        def save_panel(i, box):
+            try:
+                if resized:
+                    panel = resized[i]
+                elif strips:
+                    with timer.stage("decode"):
+                        panel = raster_io.read_region(img, box, strips, mapped=mapped)
+                    with timer.stage("crop"):
+                        panel = extract_region(panel, (0, 0) + panel.size, target_size)
+                else:
+                    with timer.stage("crop"):
+                        panel = extract_region(img, box, target_size)
+                # Resize if size is specified
+                if self.preset["size"] and not resized:
+                    with timer.stage("resize"):
+                        panel = panel.resize(self.preset["size"], Image.LANCZOS)
+
+                output_path = os.path.join(output_dir, self.output_filename(src.name, i + 1, num_panels))
+                backup_path = os.path.join(output_dir, f"{base}_panel{i+1}_backup.jpg")
+                return save_image(panel, output_path, backup_path, self.encoder, self.max_bytes, self.fsync, timer)
+            except Exception:
+                logger.exception("Error saving panel %d of %s", i + 1, src.name)
+                return None
+
+        try:
+            # Panels read through the shared file position (strips without a
+            # mapping) have to be read one at a time
+            if self.panel_threads > 1 and len(boxes) > 1 and (not strips or mapped is not None):
+                # Resize and encode release the GIL, so panels of the shared
+                # decode can be processed on threads
+                with ThreadPoolExecutor(max_workers=min(self.panel_threads, len(boxes))) as pool:
+                    saved = list(pool.map(save_panel, range(len(boxes)), boxes))
+            else:
+                saved = [save_panel(i, box) for i, box in enumerate(boxes)]
+        finally:
+            if mapped is not None:
+                mapped.close()
+
+        return [path for path in saved if path]
+
+    def plan(self, source, name=None, max_pixels=None):
+        """Work out crop boxes, split decision and outputs for one image from its header.
+
+        Images larger than max_pixels are flagged with an error so batches can
+        reject them before anything is decoded.
+        """
+        label = name or (source if isinstance(source, str) else getattr(source, "filename", "") or "<image>")
+        try:
+            with self._opened(source, name) as src:
+                size = src.size
+                image_format = src.format
+                name = src.name
+                override = self.override_for(src)
+                override_box = self._override_box(src, override)
+        except Exception as e:
+            return CropPlan(label, error=str(e))
+
+        if max_pixels and size[0] * size[1] > max_pixels:
+            return CropPlan(label, size, image_format,
+                            error=f"Image too large: {size[0]}x{size[1]} exceeds {max_pixels} pixels")
+
+        num_panels = self.split_count(size, override)
+        if num_panels:
+            boxes = compute_panel_boxes(size, self.preset, num_panels)
+            output_names = [self.output_filename(name, i + 1, num_panels) for i in range(len(boxes))]
+        else:
+            boxes = [override_box or compute_crop_box(size, self.preset)]
+            output_names = [self.output_filename(name)]
+
+        left, top, right, bottom = boxes[0]
+        output_size = self.preset["size"] or (right - left, bottom - top)
+        save_format = get_save_format(os.path.splitext(name)[1])
+        if save_format not in ESTIMATED_BYTES_PER_PIXEL:
+            # save_image falls back to PNG for unknown extensions
+            save_format = 'PNG'
+            output_names = [os.path.splitext(output_name)[0] + ".png" for output_name in output_names]
+        bytes_per_pixel = ESTIMATED_BYTES_PER_PIXEL[save_format]
+        per_output = int(output_size[0] * output_size[1] * bytes_per_pixel)
+        if self.max_bytes and save_format in SIZE_TARGET_FORMATS:
+            per_output = min(per_output, self.max_bytes)
+        estimated_bytes = per_output * len(boxes)
+
+        return CropPlan(label, size, image_format, num_panels, boxes, output_size,
+                        output_names, estimated_bytes)
+
+    def process(self, source, output_dir, name=None):
+        """Crop or split one image according to the engine settings.
+
+        Never raises for per-image problems; they are reported on the result,
+        which also carries per-stage timings.
+        """
+        label = name or (source if isinstance(source, str) else getattr(source, "filename", "") or "<image>")
+        timer = StageTimer()
+        start = time.perf_counter()
+        try:
+            with self._opened(source, name) as src:
+                # The split decision only needs the header
+                with timer.stage("open"):
+                    override = self.override_for(src)
+                    num_panels = self.split_count(src.size, override)
+                if num_panels:
+                    output_paths = self._split(src, output_dir, num_panels, timer)
+                    if output_paths:
+                        result = CropResult(label, output_paths, split=True)
+                    else:
+                        result = CropResult(label, error="No panels were saved", split=True)
+                else:
+                    result = CropResult(label, [self._crop(src, output_dir, timer, override)])
+            if self.fsync and result.ok:
+                # One directory sync covers all renames of this input
+                with timer.stage("write"):
+                    fsync_directory(output_dir)
+        except Exception as e:
+            logger.error("Error processing %s: %s", label, e)
+            result = CropResult(label, error=str(e))
+
+        result.timings = timer.stages
+        result.elapsed = time.perf_counter() - start
+        logger.debug("Processed %s in %.1fms: %s", label, result.elapsed * 1000, format_timings(result.timings))
+        return result
@@ -0,0 +1,135 @@
+"""Per-image crop overrides stored in a sidecar manifest next to the images.
+
+For a single image the GUI can record where the crop window of a preset
+should sit (a full-resolution box) and how many carousel panels it should be
+split into (0 to crop it instead). These are kept in a JSON file in the
+image's folder, keyed by file name, together with the size of the image they
+were made for; an entry for a file whose size has changed is ignored. The
+engine reads the manifest of each input's folder and applies the entries as
+they are, so one person can curate a folder and any machine can render it
+later.
+"""
+import json
+import logging
+import os
+
+MANIFEST_FILENAME = "instagram_crop_overrides.json"
+MANIFEST_VERSION = 1
+
+logger = logging.getLogger("instagram_crop.manifest")
+
+
+def manifest_path_for(image_path):
+    """Path of the manifest that holds overrides for image_path"""
+    return os.path.join(os.path.dirname(os.path.abspath(image_path)), MANIFEST_FILENAME)
+
+
+class CropManifest:
+    """Crop boxes and panel counts for the images of one folder"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.mtime_ns = None
+        self.refresh()
+
+    def refresh(self):
+        """Reload the file if it changed on disk since it was last read"""
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        if mtime_ns == self.mtime_ns:
+            return
+        self.mtime_ns = mtime_ns
+        self.entries = {}
+        if mtime_ns is None:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data.get("images", {})
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable crop overrides %s: %s", self.path, e)
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "images": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.mtime_ns = os.stat(self.path).st_mtime_ns
+
+    def raw_entry(self, image_path):
+        """Entry for image_path as stored, without checking the image size"""
+        return self.entries.get(os.path.basename(image_path))
+
+    def entry(self, image_path, size):
+        """Entry for image_path if it was made for an image of this size, else None"""
+        entry = self.raw_entry(image_path)
+        if entry is None or tuple(entry.get("size", ())) != tuple(size):
+            return None
+        return entry
+
+    def _entry_for_update(self, image_path, size):
+        name = os.path.basename(image_path)
+        entry = self.entries.get(name)
+        if entry is None or tuple(entry.get("size", ())) != tuple(size):
+            # Start over for a new or changed image
+            entry = self.entries[name] = {"size": list(size)}
+        return entry
+
+    def crop_box(self, image_path, size, preset_name):
+        entry = self.entry(image_path, size)
+        box = entry.get("crops", {}).get(preset_name) if entry else None
+        return tuple(box) if box else None
+
+    def panels(self, image_path, size):
+        entry = self.entry(image_path, size)
+        return entry.get("panels") if entry else None
+
+    def set_crop_box(self, image_path, size, preset_name, box):
+        entry = self._entry_for_update(image_path, size)
+        entry.setdefault("crops", {})[preset_name] = [int(value) for value in box]
+
+    def set_panels(self, image_path, size, panels):
+        self._entry_for_update(image_path, size)["panels"] = int(panels)
+
+    def clear_crop_box(self, image_path, preset_name):
+        """Forget the crop box of one preset; returns whether there was one"""
+        entry = self.raw_entry(image_path)
+        if not entry or entry.get("crops", {}).pop(preset_name, None) is None:
+            return False
+        if not entry["crops"]:
+            del entry["crops"]
+        self._drop_if_empty(image_path)
+        return True
+
+    def clear_panels(self, image_path):
+        """Forget the panel count; returns whether there was one"""
+        entry = self.raw_entry(image_path)
+        if not entry or entry.pop("panels", None) is None:
+            return False
+        self._drop_if_empty(image_path)
+        return True
+
+    def _drop_if_empty(self, image_path):
+        name = os.path.basename(image_path)
+        if set(self.entries[name]) <= {"size"}:
+            del self.entries[name]
+
+
+class ManifestSet:
+    """The manifests of every folder a batch touches, loaded on first use"""
+
+    def __init__(self):
+        self.manifests = {}
+
+    def for_image(self, image_path):
+        path = manifest_path_for(image_path)
+        manifest = self.manifests.get(path)
+        if manifest is None:
+            manifest = self.manifests[path] = CropManifest(path)
+        else:
+            manifest.refresh()
+        return manifest
@@ -0,0 +1,352 @@
+"""Hot-folder mode: crop images as they are dropped into a directory.
+
+On Linux new and rewritten files are picked up with inotify (through ctypes,
+so there is no extra dependency); elsewhere, or if inotify is unavailable,
+the folder is rescanned every few seconds. A file is only processed once its
+size and modification time have stayed the same for a settle period, so
+photos still being copied over the network are not cropped half-written.
+
+Which files were processed (and at which size/mtime) is kept in a JSON state
+file, so after a restart only new or modified files are processed again.
+"""
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import signal
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from crop_batch import default_workers, run_task
+from crop_engine import CropResult, is_image_file
+
+DEFAULT_SETTLE_SECONDS = 2.0
+DEFAULT_POLL_INTERVAL = 2.0
+
+STATE_FILENAME = ".instagram_crop_watch.json"
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+logger = logging.getLogger("instagram_crop.watch")
+
+
+def file_signature(path):
+    """(size, mtime_ns) of path, or None if it is gone"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def scan_directory(directory, recursive, exclude=None):
+    """All image files under directory, skipping the exclude subtree"""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        if exclude:
+            dirnames[:] = [d for d in dirnames if os.path.realpath(os.path.join(dirpath, d)) != exclude]
+        if not recursive:
+            dirnames[:] = []
+        for filename in filenames:
+            if is_image_file(filename):
+                paths.append(os.path.join(dirpath, filename))
+    return paths
+
+
+def ignore_interrupt():
+    """Pool initializer: Ctrl+C stops the watcher, which then lets running workers finish"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class PollingWatcher:
+    """Find new or changed images by rescanning the directory"""
+
+    def __init__(self, directory, recursive=False, interval=DEFAULT_POLL_INTERVAL, exclude=None):
+        self.directory = directory
+        self.recursive = recursive
+        self.interval = interval
+        self.exclude = exclude
+        self.snapshot = {}
+        self.last_scan = None
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds and return the paths that changed since the last scan"""
+        time.sleep(timeout)
+        now = time.monotonic()
+        if self.last_scan is not None and now - self.last_scan < self.interval:
+            return []
+        self.last_scan = now
+        changed = []
+        snapshot = {}
+        for path in scan_directory(self.directory, self.recursive, self.exclude):
+            signature = file_signature(path)
+            if signature is None:
+                continue
+            snapshot[path] = signature
+            if self.snapshot.get(path) != signature:
+                changed.append(path)
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Find new or changed images from inotify events (Linux only)"""
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, directory, recursive=False, exclude=None):
+        libc_name = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or not libc_name:
+            raise OSError("inotify is not available on this platform")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.directory = directory
+        self.recursive = recursive
+        self.exclude = exclude
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self._add_tree(directory)
+
+    def _add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Cannot watch {path}")
+        self.watches[wd] = path
+
+    def _add_tree(self, directory):
+        self._add_watch(directory)
+        if not self.recursive:
+            return
+        for dirpath, dirnames, _ in os.walk(directory):
+            dirnames[:] = [d for d in dirnames if os.path.realpath(os.path.join(dirpath, d)) != self.exclude]
+            for d in dirnames:
+                self._add_watch(os.path.join(dirpath, d))
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds and return the paths that were written or moved in"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped; fall back to a full scan
+                return scan_directory(self.directory, self.recursive, self.exclude)
+            parent = self.watches.get(wd)
+            if parent is None or not name:
+                continue
+            path = os.path.join(parent, name)
+            if mask & IN_ISDIR:
+                if self.recursive and os.path.realpath(path) != self.exclude:
+                    # Watch the new folder and pick up whatever was moved in with it
+                    self._add_tree(path)
+                    changed.extend(scan_directory(path, True, self.exclude))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_image_file(name):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def make_watcher(directory, recursive=False, interval=DEFAULT_POLL_INTERVAL, exclude=None, use_polling=False):
+    """inotify watcher where possible, polling otherwise"""
+    if not use_polling:
+        try:
+            return InotifyWatcher(directory, recursive, exclude)
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify unavailable (%s), polling every %gs instead", e, interval)
+    return PollingWatcher(directory, recursive, interval, exclude)
+
+
+class WatchState:
+    """Processed files and the signature they had, persisted as JSON"""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.dirty = False
+        try:
+            with open(path) as f:
+                self.files = json.load(f).get("files", {})
+        except (OSError, ValueError):
+            pass
+
+    def is_done(self, path, signature):
+        entry = self.files.get(os.path.realpath(path))
+        return entry is not None and (entry["size"], entry["mtime_ns"]) == tuple(signature)
+
+    def record(self, path, signature, result):
+        self.files[os.path.realpath(path)] = {
+            "size": signature[0],
+            "mtime_ns": signature[1],
+            "outputs": result.output_paths,
+            "error": result.error,
+        }
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"files": self.files}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+class FolderWatcher:
+    """Crop every new or modified image in watch_dir into output_dir until stopped"""
+
+    def __init__(self, engine, watch_dir, output_dir, state_path=None, workers=None, recursive=False,
+                 settle=DEFAULT_SETTLE_SECONDS, interval=DEFAULT_POLL_INTERVAL, use_polling=False,
+                 cache=None, on_result=None):
+        self.engine = engine
+        self.watch_dir = watch_dir
+        self.output_dir = output_dir
+        self.workers = max(1, workers or default_workers())
+        self.recursive = recursive
+        self.settle = settle
+        self.interval = interval
+        self.use_polling = use_polling
+        self.cache = cache
+        self.on_result = on_result
+        self.state = WatchState(state_path or os.path.join(output_dir, STATE_FILENAME))
+        # path -> [signature, time the signature was last seen to change]
+        self.pending = {}
+        # path -> (future, signature)
+        self.in_flight = {}
+        # Files that changed again while they were being processed
+        self.rechecks = set()
+
+    def notice(self, path, now):
+        """Queue path for processing once it has settled, unless it is already done"""
+        signature = file_signature(path)
+        if signature is None:
+            self.pending.pop(path, None)
+            return
+        if path in self.in_flight:
+            self.rechecks.add(path)
+            return
+        if self.state.is_done(path, signature):
+            return
+        entry = self.pending.get(path)
+        if entry is None or entry[0] != signature:
+            self.pending[path] = [signature, now]
+
+    def settled(self, now):
+        """Pop and return the pending files that have stopped changing"""
+        ready = []
+        for path, entry in list(self.pending.items()):
+            signature = file_signature(path)
+            if signature is None:
+                del self.pending[path]
+            elif signature != entry[0]:
+                self.pending[path] = [signature, now]
+            elif now - entry[1] >= self.settle:
+                del self.pending[path]
+                ready.append((path, signature))
+        return ready
+
+    def submit(self, pool, path, signature):
+        if self.cache is not None:
+            output_paths = self.cache.lookup(path, self.output_dir, self.engine)
+            if output_paths is not None:
+                self.finish(path, signature, CropResult(path, output_paths, split=len(output_paths) > 1,
+                                                        cached=True))
+                return
+        logger.debug("Processing %s", path)
+        self.in_flight[path] = (pool.submit(run_task, self.engine, self.output_dir, path), signature)
+
+    def finish(self, path, signature, result):
+        self.state.record(path, signature, result)
+        if self.on_result:
+            self.on_result(result)
+
+    def collect(self, now):
+        """Record the results of finished tasks"""
+        for path, (future, signature) in list(self.in_flight.items()):
+            if not future.done():
+                continue
+            del self.in_flight[path]
+            if future.cancelled():
+                # Not processed; it is picked up again on the next start
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                result = CropResult(path, error=str(e))
+            if self.cache is not None and result.ok:
+                self.cache.store(path, result.output_paths, self.engine)
+            self.finish(path, signature, result)
+            if path in self.rechecks:
+                self.rechecks.discard(path)
+                self.notice(path, now)
+
+    def run(self, stop_event=None):
+        """Watch until stop_event (a threading.Event) is set or KeyboardInterrupt"""
+        exclude = os.path.realpath(self.output_dir)
+        watcher = make_watcher(self.watch_dir, self.recursive, self.interval, exclude, self.use_polling)
+        # Files that arrived while we weren't running
+        now = time.monotonic()
+        for path in scan_directory(self.watch_dir, self.recursive, exclude):
+            self.notice(path, now)
+
+        # Wake up often enough to notice files settling
+        tick = max(0.1, min(self.interval, self.settle / 2)) if self.settle else self.interval
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=ignore_interrupt) as pool:
+                try:
+                    while stop_event is None or not stop_event.is_set():
+                        changed = watcher.poll(tick)
+                        now = time.monotonic()
+                        for path in changed:
+                            self.notice(path, now)
+                        for path, signature in self.settled(now):
+                            self.submit(pool, path, signature)
+                        self.collect(now)
+                        self.save()
+                finally:
+                    # Let running files finish so their state is recorded
+                    for future, _ in self.in_flight.values():
+                        future.cancel()
+                    pool.shutdown(wait=True)
+                    self.collect(time.monotonic())
+                    self.save()
+        finally:
+            watcher.close()
+
+    def save(self):
+        self.state.save()
+        if self.cache is not None:
+            self.cache.save()
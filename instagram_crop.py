@@ -1,7 +1,155 @@
 import os
 import sys
 from PIL import Image, ImageTk
-from tkinter import Tk, filedialog, Button, Label, StringVar, OptionMenu, Frame, Canvas, PhotoImage, BOTH, TOP, BOTTOM, LEFT, RIGHT, X, Y, HORIZONTAL, VERTICAL, SOLID, messagebox, ttk, IntVar, Checkbutton
+from tkinter import Tk, Toplevel, filedialog, Button, Label, StringVar, OptionMenu, Frame, Canvas, PhotoImage, BOTH, TOP, BOTTOM, LEFT, RIGHT, X, Y, HORIZONTAL, VERTICAL, SOLID, messagebox, ttk, IntVar, Checkbutton
+import collections
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import crop_engine
+import crop_saliency
+from crop_batch import BatchRunner, BatchSummary, default_workers, log_summary, plan_batch
+from crop_engine import PRESETS, DEFAULT_PRESET, DEFAULT_ENCODER, ENCODER_PROFILES, CropEngine
+from crop_manifest import ManifestSet
+from output_cache import OutputCache, default_cache_dir
+from preview_loader import THUMB_SIZE, PreviewLoader
+from thumb_cache import ThumbCache
+
+logger = logging.getLogger("instagram_crop.gui")
+
+def format_duration(seconds):
+    """Format seconds as m:ss or h:mm:ss for the progress window"""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+class ProgressWindow:
+    """Non-blocking progress dialog with throughput/ETA and a Cancel button"""
+    
+    def __init__(self, root, total, on_cancel):
+        self.total = total
+        self.total_outputs = None  # Known once the header-only plan is ready
+        self.on_cancel = on_cancel
+        
+        self.window = Toplevel(root)
+        self.window.title("Processing Images")
+        self.window.geometry("320x190")
+        self.window.configure(bg="#f0f0f0")
+        self.window.transient(root)
+        self.window.protocol("WM_DELETE_WINDOW", self.cancel)
+        
+        Label(self.window, text="Processing images...", font=("Helvetica", 10), bg="#f0f0f0").pack(pady=(15, 5))
+        
+        self.progress = ttk.Progressbar(self.window, orient=HORIZONTAL, length=270, mode='determinate')
+        self.progress.pack(pady=5, padx=20)
+        self.progress["maximum"] = max(total, 1)
+        
+        self.status_text = StringVar()
+        self.status_text.set(f"Scanning {total} images...")
+        Label(self.window, textvariable=self.status_text, font=("Helvetica", 9), bg="#f0f0f0").pack(pady=(5, 0))
+        
+        self.rate_text = StringVar()
+        self.rate_text.set("Starting...")
+        Label(self.window, textvariable=self.rate_text, font=("Helvetica", 9), bg="#f0f0f0", fg="#555555").pack(pady=(0, 5))
+        
+        self.cancel_btn = ttk.Button(self.window, text="Cancel", command=self.cancel)
+        self.cancel_btn.pack(pady=5)
+    
+    def set_plan(self, plan):
+        """Switch the bar from counting files to counting planned output images"""
+        self.total_outputs = plan.total_outputs
+        self.progress["maximum"] = max(self.total_outputs, 1)
+    
+    def update_progress(self, done, outputs_done, elapsed):
+        if self.total_outputs is None:
+            return
+        self.progress["value"] = outputs_done
+        self.status_text.set(f"Processing {done}/{self.total} ({outputs_done}/{self.total_outputs} outputs)")
+        if outputs_done and elapsed > 0:
+            rate = outputs_done / elapsed
+            eta = (self.total_outputs - outputs_done) / rate
+            self.rate_text.set(f"{rate * 60:.0f} outputs/min, ETA {format_duration(eta)}")
+    
+    def cancel(self):
+        self.cancel_btn.config(state="disabled", text="Cancelling...")
+        self.on_cancel()
+    
+    def destroy(self):
+        self.window.destroy()
+
+
+class PreviewCache:
+    """Small LRU cache of rendered preview PhotoImages for the loaded image"""
+    
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+    
+    def get(self, key):
+        photo = self.entries.get(key)
+        if photo is not None:
+            self.entries.move_to_end(key)
+        return photo
+    
+    def put(self, key, photo):
+        self.entries[key] = photo
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def clear(self):
+        self.entries.clear()
+
+
+def render_preview(img, size):
+    """High-quality preview render; runs on the preview thread"""
+    return img.resize(size, Image.LANCZOS, reducing_gap=crop_engine.DECODE_REDUCING_GAP)
+
+
+class PreviewSlot:
+    """A canvas showing one preview image that is updated in place instead of redrawn"""
+    
+    def __init__(self, canvas, default_size):
+        self.canvas = canvas
+        self.default_size = default_size
+        self.item = None
+        self.photo = None  # Keeps the shown PhotoImage alive
+        self.position = None
+        self.extent = None  # (x, y, width, height) of the image last shown
+    
+    def size(self):
+        """Current canvas size, or the default while it hasn't been laid out yet"""
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        if width <= 1 or height <= 1:
+            return self.default_size
+        return width, height
+    
+    def show(self, photo, x, y):
+        if photo is self.photo and (x, y) == self.position:
+            return
+        if self.item is None:
+            self.item = self.canvas.create_image(x, y, anchor="nw", image=photo)
+        else:
+            self.canvas.itemconfigure(self.item, image=photo)
+            self.canvas.coords(self.item, x, y)
+        self.photo = photo
+        self.position = (x, y)
+    
+    def clear(self):
+        if self.item is not None:
+            self.canvas.delete(self.item)
+        self.item = None
+        self.photo = None
+        self.position = None
+        self.extent = None
+
 
 class InstagramCropTool:
     def __init__(self, root):
@@ -13,20 +161,31 @@ class InstagramCropTool:
         self.root.minsize(800, 550)  # Set minimum window size
         
         # Presets for Instagram
-        self.presets = {
-            "Feed (4:5)": {"ratio": (4, 5), "size": (1080, 1350)},
-            "Grid Feed (3:4)": {"ratio": (3, 4), "size": (354, 472)},
-            "Reels (9:16)": {"ratio": (9, 16), "size": None}
-        }
+        self.presets = PRESETS
         
         self.selected_preset = StringVar(root)
-        self.selected_preset.set("Feed (4:5)")  # default value
+        self.selected_preset.set(DEFAULT_PRESET)  # default value
         self.selected_preset.trace("w", self.update_preview)  # Update preview when preset changes
+        self.selected_preset.trace("w", lambda *args: self.update_filmstrip())  # Split badges depend on it
         
+        # Smart crop option (follow the subject instead of centering)
+        self.smart_crop = IntVar()
+        self.smart_crop.set(0)
+        self.smart_crop.trace("w", self.update_preview)
+        
+        # Encoder profile used when saving
+        self.selected_encoder = StringVar(root)
+        self.selected_encoder.set(DEFAULT_ENCODER)
+
         # Split wide images option
         self.split_wide_images = IntVar()
         self.split_wide_images.set(0)  # Default: not splitting
         self.split_wide_images.trace("w", self.update_preview)  # Update preview when option changes
+        
+        # Smart split option (move panel borders off detailed areas)
+        self.smart_split = IntVar()
+        self.smart_split.set(0)
+        self.smart_split.trace("w", self.update_preview)
 
         # Number of panels for split
         self.split_panels = IntVar()
@@ -36,12 +195,59 @@ class InstagramCropTool:
         # Maximum allowed panels based on image width
         self.max_allowed_panels = 2
         
+        # Worker processes used by process_images
+        self.workers = default_workers()
+        self.batch_poll_delay = 100  # milliseconds
+        # Finished outputs are cached so re-running a folder only renders new or changed photos
+        self.output_cache_dir = default_cache_dir()
+        
         # Image variables
         self.current_image_path = None
-        self.original_image = None
-        self.preview_original = None
-        self.preview_cropped = None
-        self.preview_images = []  # List of cropped preview images (for split view)
+        self.original_image = None  # Screen-sized proxy used for every preview
+        self.original_size = None  # Full-resolution size of the loaded image
+        
+        # Per-image crop boxes and panel counts, saved next to the images and
+        # applied by the batch engine as well
+        self.manifests = ManifestSet()
+        self.preview_box = None  # Crop box of the standard preview, on the proxy
+        self.crop_drag = None  # (x, y, full-resolution box) while the crop is being dragged
+        
+        # Rendered previews keyed by (view, preset, panels, canvas size)
+        self.preview_cache = PreviewCache()
+        # Cropped or split proxies for the current settings, and what was last drawn
+        self.preview_source_key = None
+        self.preview_sources = []
+        self.rendered_key = None
+        # Panel count of the visible preview layout (0 for the standard view)
+        self.preview_layout = None
+        
+        # Previews are drawn with a fast NEAREST pass first and refined with
+        # LANCZOS on this thread; a new render cancels the older refinements
+        self.preview_pool = ThreadPoolExecutor(max_workers=1)
+        self.preview_generation = 0
+        self.refinements = []  # (future, generation, cache key, slot, position)
+        self.refine_poll_delay = 30  # milliseconds
+        self.refine_polling = False
+        
+        # Folder session: proxies and thumbnails are decoded in the background,
+        # and the neighbours of the current image are prefetched
+        # Thumbnails, slow-to-decode proxies and image metadata persist across sessions
+        self.thumb_cache_dir = os.path.join(self.output_cache_dir, "previews")
+        self.thumb_cache_bytes = 512 * 1024 ** 2
+        try:
+            thumb_cache = ThumbCache(self.thumb_cache_dir, self.thumb_cache_bytes)
+        except Exception as e:
+            logger.warning("Preview cache unavailable: %s", e)
+            thumb_cache = None
+        screen_size = (self.root.winfo_screenwidth(), self.root.winfo_screenheight())
+        self.preview_loader = PreviewLoader(screen_size, cache=thumb_cache)
+        self.session_paths = []
+        self.session_index = None
+        self.pending_image = None  # (path, future) of the image waiting to be shown
+        self.filmstrip_items = {}  # index -> [placeholder item, image item, PhotoImage, panel badge item]
+        self.filmstrip_pitch = THUMB_SIZE + 8
+        self.filmstrip_poll_delay = 50  # milliseconds
+        self.filmstrip_polling = False
         
         # Create UI elements
         self.setup_ui()
@@ -113,6 +319,23 @@ class InstagramCropTool:
         self.format_info.pack(fill=X, pady=(0, 15))
         self.update_format_info()  # Initial update
         
+        smart_text = "Smart crop (follow the subject)"
+        if not crop_saliency.available():
+            smart_text += "\nneeds NumPy"
+        smart_check = Checkbutton(controls_frame, text=smart_text, variable=self.smart_crop,
+                                  font=("Helvetica", 10), bg="#f5f5f5", anchor="w", justify=LEFT,
+                                  state="normal" if crop_saliency.available() else "disabled")
+        smart_check.pack(fill=X, pady=(0, 15))
+        
+        # Encoder profile: trade file size against encoding time per job
+        encoder_label = Label(controls_frame, text="Output Quality", font=("Helvetica", 12, "bold"), 
+                             bg="#f5f5f5", anchor="w")
+        encoder_label.pack(fill=X, pady=(0, 5))
+        
+        encoder_menu = ttk.OptionMenu(controls_frame, self.selected_encoder, 
+                                    self.selected_encoder.get(), *ENCODER_PROFILES.keys())
+        encoder_menu.pack(fill=X, pady=(0, 15))
+        
         # Wide image handling options
         wide_image_frame = Frame(controls_frame, bg="#f5f5f5", pady=5)
         wide_image_frame.pack(fill=X)
@@ -127,6 +350,14 @@ class InstagramCropTool:
                                bg="#f5f5f5", anchor="w")
         split_check.pack(fill=X, pady=5)
         
+        smart_split_text = "Smart panel borders (avoid cutting subjects)"
+        if not crop_saliency.available():
+            smart_split_text += "\nneeds NumPy"
+        smart_split_check = Checkbutton(wide_image_frame, text=smart_split_text, variable=self.smart_split,
+                                        font=("Helvetica", 10), bg="#f5f5f5", anchor="w", justify=LEFT,
+                                        state="normal" if crop_saliency.available() else "disabled")
+        smart_split_check.pack(fill=X, padx=(20, 0), pady=(0, 5))
+        
         # Panel count frame and label
         panel_label_frame = Frame(wide_image_frame, bg="#f5f5f5")
         panel_label_frame.pack(fill=X, pady=(0, 5))
@@ -163,6 +394,17 @@ class InstagramCropTool:
                         anchor="w", justify=LEFT)
         wide_info.pack(fill=X, padx=(20, 0), pady=(0, 5))
         
+        # Per-image overrides: drag the crop on the original, keep the panel count
+        image_frame = Frame(controls_frame, bg="#f5f5f5")
+        image_frame.pack(fill=X, pady=(5, 0))
+        
+        keep_panels_btn = ttk.Button(image_frame, text="Keep Panels for This Image",
+                                     command=self.save_panel_override, style='TButton')
+        keep_panels_btn.pack(side=LEFT, fill=X, expand=True, padx=(0, 2))
+        
+        reset_btn = ttk.Button(image_frame, text="Reset Image", command=self.reset_overrides, style='TButton')
+        reset_btn.pack(side=LEFT, fill=X, expand=True, padx=(2, 0))
+        
         # Separator
         ttk.Separator(controls_frame, orient=HORIZONTAL).pack(fill=X, pady=10)
         
@@ -173,8 +415,11 @@ class InstagramCropTool:
         select_btn = ttk.Button(controls_frame, text="Select Image", command=self.select_image, style='TButton')
         select_btn.pack(fill=X, pady=5)
         
-        process_btn = ttk.Button(controls_frame, text="Process Image(s)", command=self.process_images, style='TButton')
-        process_btn.pack(fill=X, pady=5)
+        folder_btn = ttk.Button(controls_frame, text="Open Folder", command=self.open_folder, style='TButton')
+        folder_btn.pack(fill=X, pady=5)
+        
+        self.process_btn = ttk.Button(controls_frame, text="Process Image(s)", command=self.process_images, style='TButton')
+        self.process_btn.pack(fill=X, pady=5)
         
         # Status
         self.status_frame = Frame(controls_frame, bg="#f5f5f5", height=30)
@@ -196,8 +441,13 @@ class InstagramCropTool:
         self.preview_container = Frame(self.preview_frame, bg="white")
         self.preview_container.pack(fill=BOTH, expand=True)
         
-        # Original image preview
+        # Filmstrip of the opened folder, shown once a folder is opened
+        self.setup_filmstrip()
+        
+        # Both layouts are built once and swapped; update_preview only changes their images
         self.setup_standard_preview()
+        self.setup_split_preview()
+        self.show_preview_layout(0)
         
         # Footer
         footer_frame = Frame(main_frame, bg="#f0f0f0")
@@ -206,90 +456,98 @@ class InstagramCropTool:
         credits = Label(footer_frame, text="Made with ❤️", font=("Helvetica", 8), bg="#f0f0f0", fg="#888888")
         credits.pack(side=RIGHT)
     
-    def setup_standard_preview(self):
-        # Clear the preview container
-        for widget in self.preview_container.winfo_children():
-            widget.destroy()
+    def setup_filmstrip(self):
+        self.filmstrip_frame = Frame(self.preview_frame, bg="white")
+        
+        self.filmstrip_canvas = Canvas(self.filmstrip_frame, bg="#f8f8f8", height=self.filmstrip_pitch,
+                                       highlightthickness=1, highlightbackground="#e0e0e0")
+        self.filmstrip_canvas.pack(fill=X)
+        
+        scrollbar = ttk.Scrollbar(self.filmstrip_frame, orient=HORIZONTAL, command=self.filmstrip_canvas.xview)
+        scrollbar.pack(fill=X)
+        
+        def on_scroll(first, last):
+            scrollbar.set(first, last)
+            self.update_filmstrip()
+        
+        self.filmstrip_canvas.configure(xscrollcommand=on_scroll)
+        self.filmstrip_canvas.bind("<Button-1>", self.on_filmstrip_click)
+        self.filmstrip_marker = self.filmstrip_canvas.create_rectangle(0, 0, 0, 0, outline="#4f5bd5", width=3)
         
+        # Arrow keys step through the folder
+        self.root.bind("<Left>", lambda event: self.step_session(-1))
+        self.root.bind("<Right>", lambda event: self.step_session(1))
+    
+    def setup_standard_preview(self):
         # Preview area - split into before and after
-        preview_split = Frame(self.preview_container, bg="white")
-        preview_split.pack(fill=BOTH, expand=True)
+        self.standard_view = Frame(self.preview_container, bg="white")
         
         # Original image preview
-        original_frame = Frame(preview_split, bg="white", padx=5, pady=5, width=250)
+        original_frame = Frame(self.standard_view, bg="white", padx=5, pady=5, width=250)
         original_frame.pack(side=LEFT, fill=BOTH, expand=True, padx=(0, 5))
         
         Label(original_frame, text="Original", font=("Helvetica", 10, "bold"), bg="white").pack(pady=(0, 5))
         
-        self.original_canvas = Canvas(original_frame, bg="#f8f8f8", highlightthickness=1, 
-                                   highlightbackground="#e0e0e0")
-        self.original_canvas.pack(fill=BOTH, expand=True)
+        original_canvas = Canvas(original_frame, bg="#f8f8f8", highlightthickness=1, 
+                                 highlightbackground="#e0e0e0")
+        original_canvas.pack(fill=BOTH, expand=True)
+        self.original_slot = PreviewSlot(original_canvas, (250, 250))
+        
+        # Outline of the crop; dragging it moves the crop of this image
+        self.crop_outline = original_canvas.create_rectangle(0, 0, 0, 0, outline="#4f5bd5", width=2,
+                                                             state="hidden")
+        original_canvas.bind("<ButtonPress-1>", self.start_crop_drag)
+        original_canvas.bind("<B1-Motion>", self.drag_crop)
+        original_canvas.bind("<ButtonRelease-1>", self.end_crop_drag)
         
         # Separator
-        sep_frame = Frame(preview_split, bg="white", width=1)
+        sep_frame = Frame(self.standard_view, bg="white", width=1)
         sep_frame.pack(side=LEFT, fill=Y, padx=2)
         ttk.Separator(sep_frame, orient=VERTICAL).pack(fill=Y, expand=True)
         
         # Cropped image preview
-        cropped_frame = Frame(preview_split, bg="white", padx=5, pady=5, width=250)
+        cropped_frame = Frame(self.standard_view, bg="white", padx=5, pady=5, width=250)
         cropped_frame.pack(side=RIGHT, fill=BOTH, expand=True, padx=(5, 0))
         
         Label(cropped_frame, text="Cropped Preview", font=("Helvetica", 10, "bold"), bg="white").pack(pady=(0, 5))
         
-        self.cropped_canvas = Canvas(cropped_frame, bg="#f8f8f8", highlightthickness=1, 
-                                  highlightbackground="#e0e0e0")
-        self.cropped_canvas.pack(fill=BOTH, expand=True)
+        cropped_canvas = Canvas(cropped_frame, bg="#f8f8f8", highlightthickness=1, 
+                                highlightbackground="#e0e0e0")
+        cropped_canvas.pack(fill=BOTH, expand=True)
+        self.cropped_slot = PreviewSlot(cropped_canvas, (250, 250))
         
         # Add weight to properly distribute space
-        preview_split.columnconfigure(0, weight=1)
-        preview_split.columnconfigure(2, weight=1)
+        self.standard_view.columnconfigure(0, weight=1)
+        self.standard_view.columnconfigure(2, weight=1)
     
-    def setup_split_preview(self, num_panels):
-        # Clear the preview container
-        for widget in self.preview_container.winfo_children():
-            widget.destroy()
+    def setup_split_preview(self):
+        """Build the split view with a panel for the largest panel count; unused panels are hidden"""
+        self.split_view = Frame(self.preview_container, bg="white")
         
         # Original image frame
-        orig_frame = Frame(self.preview_container, bg="white", height=120)
+        orig_frame = Frame(self.split_view, bg="white", height=120)
         orig_frame.pack(fill=X, pady=(0, 10))
         
         Label(orig_frame, text="Original", font=("Helvetica", 10, "bold"), bg="white").pack(pady=(0, 5))
         
-        self.original_canvas = Canvas(orig_frame, bg="#f8f8f8", height=100, highlightthickness=1, 
-                                   highlightbackground="#e0e0e0")
-        self.original_canvas.pack(fill=X)
+        wide_canvas = Canvas(orig_frame, bg="#f8f8f8", height=100, highlightthickness=1, 
+                             highlightbackground="#e0e0e0")
+        wide_canvas.pack(fill=X)
+        self.wide_slot = PreviewSlot(wide_canvas, (400, 100))
         
         # Label for split panels
-        Label(self.preview_container, text=f"Split Preview ({num_panels} panels for carousel)", 
-            font=("Helvetica", 10, "bold"), bg="white").pack(pady=(5, 10))
-        
-        # Create split preview grid
-        split_frame = Frame(self.preview_container, bg="white")
-        split_frame.pack(fill=BOTH, expand=True)
+        self.split_title = Label(self.split_view, text="", font=("Helvetica", 10, "bold"), bg="white")
+        self.split_title.pack(pady=(5, 10))
         
-        # Create canvas for each panel
-        self.split_canvases = []
+        # Split preview grid
+        self.split_grid = Frame(self.split_view, bg="white")
+        self.split_grid.pack(fill=BOTH, expand=True)
         
-        # Calculate grid layout
-        if num_panels <= 3:
-            cols = num_panels
-            rows = 1
-        else:
-            cols = 3
-            rows = (num_panels + 2) // 3  # Ceiling division
-        
-        # Create frames for each panel
-        for i in range(num_panels):
-            row = i // cols
-            col = i % cols
-            
-            # Panel frame
-            panel_frame = Frame(split_frame, bg="white", padx=3, pady=3)
-            panel_frame.grid(row=row, column=col, sticky="nsew")
-            
-            # Make columns and rows expandable
-            split_frame.grid_columnconfigure(col, weight=1)
-            split_frame.grid_rowconfigure(row, weight=1)
+        self.panel_frames = []
+        self.panel_slots = []
+        for i in range(crop_engine.MAX_PANELS):
+            # Panel frame, gridded by show_preview_layout
+            panel_frame = Frame(self.split_grid, bg="white", padx=3, pady=3)
             
             # Panel number label
             Label(panel_frame, text=f"Panel {i+1}", font=("Helvetica", 9), bg="white").pack(pady=(0, 3))
@@ -298,7 +556,40 @@ class InstagramCropTool:
             canvas = Canvas(panel_frame, bg="#f8f8f8", highlightthickness=1, highlightbackground="#e0e0e0")
             canvas.pack(fill=BOTH, expand=True)
             
-            self.split_canvases.append(canvas)
+            self.panel_frames.append(panel_frame)
+            self.panel_slots.append(PreviewSlot(canvas, (150, 150)))
+    
+    def show_preview_layout(self, num_panels):
+        """Show the standard view (num_panels 0) or the split view with num_panels panels"""
+        if num_panels == self.preview_layout:
+            return
+        if num_panels:
+            self.standard_view.pack_forget()
+            self.split_title.config(text=f"Split Preview ({num_panels} panels for carousel)")
+            
+            # Calculate grid layout
+            cols = num_panels if num_panels <= 3 else 3
+            rows = (num_panels + cols - 1) // cols
+            for i, (panel_frame, slot) in enumerate(zip(self.panel_frames, self.panel_slots)):
+                if i < num_panels:
+                    panel_frame.grid(row=i // cols, column=i % cols, sticky="nsew")
+                else:
+                    panel_frame.grid_remove()
+                    slot.clear()
+            
+            # Only the columns and rows in use share the space
+            for col in range(3):
+                self.split_grid.grid_columnconfigure(col, weight=1 if col < cols else 0)
+            for row in range((crop_engine.MAX_PANELS + 2) // 3):
+                self.split_grid.grid_rowconfigure(row, weight=1 if row < rows else 0)
+            self.split_view.pack(fill=BOTH, expand=True)
+        else:
+            self.split_view.pack_forget()
+            self.standard_view.pack(fill=BOTH, expand=True)
+        self.preview_layout = num_panels
+        
+        # Lay out the newly shown canvases so their real size is known
+        self.preview_container.update_idletasks()
     
     def update_format_info(self):
         preset = self.presets[self.selected_preset.get()]
@@ -332,7 +623,7 @@ class InstagramCropTool:
             min_widths[panels] = std_width * panels
         
         # Get image width
-        img_width = self.original_image.size[0]
+        img_width = self.original_size[0]
         
         # Determine how many panels this image can be split into
         max_panels = 1
@@ -373,12 +664,16 @@ class InstagramCropTool:
             if self.split_panels.get() > max_panels:
                 self.split_panels.set(max_panels)
             
+        panels = self.saved_panels()
+        if panels is not None:
+            info_text += f"\nKept for this image: {f'{panels} panels' if panels else 'crop, no split'}"
+        
         # Update info text
         self.split_info.config(text=info_text, fg=info_color)
     
     def select_image(self):
         filetypes = [
-            ("Image files", "*.jpg *.jpeg *.png *.webp"),
+            ("Image files", "*.jpg *.jpeg *.png *.webp *.tif *.tiff *.bmp *.ppm *.pgm *.tga"),
             ("All files", "*.*")
         ]
         
@@ -389,23 +684,182 @@ class InstagramCropTool:
         
         if not filename:
             return
-            
-        self.current_image_path = filename
+        
+        self.close_session()
         self.load_preview_image(filename)
         self.status_label.config(text=f"Image loaded: {os.path.basename(filename)}")
     
     def load_preview_image(self, image_path):
         try:
-            # Open the image
-            self.original_image = Image.open(image_path)
-            
-            # Update split info
-            self.update_split_info()
-            
-            # Update the preview display
-            self.update_preview()
+            # Decode a screen-sized proxy that all crop/split previews are derived from
+            img, size = self.preview_loader.load(image_path)
         except Exception as e:
             messagebox.showerror("Error", f"Could not load image: {str(e)}")
+            return
+        self.show_loaded_image(image_path, img, size)
+    
+    def show_loaded_image(self, path, img, size):
+        """Make a decoded proxy the current image.
+
+        current_image_path only changes here, so crop drags and overrides made
+        while the next image is still decoding apply to the one on screen.
+        """
+        self.current_image_path = path
+        self.original_image = img
+        self.original_size = size
+        self.crop_drag = None
+        self.preview_cache.clear()
+        self.preview_source_key = None
+        self.rendered_key = None
+        
+        # Update the preview display (which also updates the split info)
+        self.update_preview()
+    
+    def open_folder(self):
+        """Browse the images of a folder in the filmstrip"""
+        folder = filedialog.askdirectory(title="Select Folder")
+        if not folder:
+            return
+        
+        paths = list(crop_engine.iter_directory(folder, False))
+        if not paths:
+            messagebox.showinfo("Open Folder", "No images found in this folder")
+            return
+        
+        self.close_session()
+        self.session_paths = paths
+        self.filmstrip_canvas.configure(scrollregion=(0, 0, len(paths) * self.filmstrip_pitch, self.filmstrip_pitch))
+        self.filmstrip_frame.pack(side=BOTTOM, fill=X, pady=(10, 0), before=self.preview_container)
+        self.show_session_image(0)
+    
+    def close_session(self):
+        """Forget the opened folder and hide the filmstrip"""
+        if not self.session_paths:
+            return
+        self.session_paths = []
+        self.session_index = None
+        self.pending_image = None
+        for item in self.filmstrip_items.values():
+            self.delete_filmstrip_item(item)
+        self.filmstrip_items = {}
+        self.filmstrip_frame.pack_forget()
+        self.preview_loader.clear()
+    
+    def step_session(self, step):
+        if self.session_index is not None:
+            self.show_session_image(self.session_index + step)
+    
+    def on_filmstrip_click(self, event):
+        index = int(self.filmstrip_canvas.canvasx(event.x) // self.filmstrip_pitch)
+        if 0 <= index < len(self.session_paths):
+            self.show_session_image(index)
+    
+    def show_session_image(self, index):
+        """Show the index-th image of the folder: at once when prefetched, otherwise once it is decoded"""
+        index = min(max(index, 0), len(self.session_paths) - 1)
+        if index == self.session_index:
+            return
+        self.session_index = index
+        path = self.session_paths[index]
+        
+        # Highlight it and scroll it into view
+        pitch = self.filmstrip_pitch
+        self.filmstrip_canvas.coords(self.filmstrip_marker, index * pitch + 2, 2, (index + 1) * pitch - 2, pitch - 2)
+        first, last = self.filmstrip_canvas.xview()
+        position = index / len(self.session_paths)
+        if not first <= position < last - 1 / len(self.session_paths):
+            self.filmstrip_canvas.xview_moveto(max(0.0, position - (last - first) / 2))
+        
+        entry = self.preview_loader.get(path)
+        if entry is not None:
+            self.pending_image = None
+            self.show_loaded_image(path, *entry)
+            self.status_label.config(text=f"Image {index + 1}/{len(self.session_paths)}: {os.path.basename(path)}")
+        else:
+            self.pending_image = (path, self.preview_loader.request(path))
+            self.status_label.config(text=f"Loading {os.path.basename(path)}...")
+            self.root.after(self.filmstrip_poll_delay, self.poll_pending_image)
+        self.preview_loader.prefetch(self.session_paths, index)
+    
+    def poll_pending_image(self):
+        """Show the image the user moved to once its background decode finishes"""
+        if self.pending_image is None:
+            return
+        path, future = self.pending_image
+        if not future.done():
+            self.root.after(self.filmstrip_poll_delay, self.poll_pending_image)
+            return
+        self.pending_image = None
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.status_label.config(text=f"Could not load {os.path.basename(path)}")
+            return
+        self.show_loaded_image(path, *future.result())
+        self.status_label.config(
+            text=f"Image {self.session_index + 1}/{len(self.session_paths)}: {os.path.basename(path)}")
+    
+    def update_filmstrip(self):
+        """Draw thumbnails in and near the visible part of the filmstrip and drop the rest"""
+        if not self.session_paths:
+            return
+        canvas = self.filmstrip_canvas
+        pitch = self.filmstrip_pitch
+        preset_name = self.selected_preset.get()
+        width = max(canvas.winfo_width(), pitch)
+        visible_first = int(canvas.canvasx(0) // pitch)
+        visible_count = width // pitch + 1
+        # One screen of thumbnails on each side is kept ready for scrolling
+        first = max(0, visible_first - visible_count)
+        last = min(len(self.session_paths), visible_first + 2 * visible_count)
+        
+        for index in [i for i in self.filmstrip_items if not first <= i < last]:
+            self.delete_filmstrip_item(self.filmstrip_items.pop(index))
+        self.preview_loader.cancel_thumbnails(set(self.session_paths[first:last]))
+        
+        waiting = False
+        for index in range(first, last):
+            item = self.filmstrip_items.get(index)
+            if item is None:
+                placeholder = canvas.create_rectangle(index * pitch + 4, 4, (index + 1) * pitch - 4, pitch - 4,
+                                                      fill="#e8e8e8", outline="")
+                item = self.filmstrip_items[index] = [placeholder, None, None, None]
+            path = self.session_paths[index]
+            if item[1] is None:
+                thumb = self.preview_loader.thumbnail(path)
+                if thumb is None and self.preview_loader.thumbnail_failed(path):
+                    # Unreadable file: mark it once and stop asking for it
+                    if item[3] is None:
+                        canvas.itemconfigure(item[0], fill="#f4dcdc")
+                        item[3] = canvas.create_text(index * pitch + pitch // 2, pitch // 2, text="Unreadable",
+                                                     fill="#c0392b", font=("Helvetica", 8, "bold"))
+                    continue
+                if thumb is None:
+                    self.preview_loader.request_thumbnail(path)
+                    waiting = True
+                    continue
+                item[2] = ImageTk.PhotoImage(thumb)
+                item[1] = canvas.create_image(index * pitch + pitch // 2, pitch // 2, image=item[2])
+                item[3] = canvas.create_text((index + 1) * pitch - 6, pitch - 6, anchor="se", fill="#4f5bd5",
+                                             font=("Helvetica", 8, "bold"))
+            # Mark images that can be split for the current preset, from the
+            # metadata kept with the thumbnail (the file isn't opened)
+            max_panels = (self.preview_loader.max_panels(path) or {}).get(preset_name, 0)
+            canvas.itemconfigure(item[3], text=f"{max_panels} panels" if max_panels >= crop_engine.MIN_PANELS else "")
+        canvas.tag_raise(self.filmstrip_marker)
+        
+        if waiting and not self.filmstrip_polling:
+            self.filmstrip_polling = True
+            self.root.after(self.filmstrip_poll_delay, self.poll_filmstrip)
+    
+    def delete_filmstrip_item(self, item):
+        for canvas_item in (item[0], item[1], item[3]):
+            if canvas_item is not None:
+                self.filmstrip_canvas.delete(canvas_item)
+    
+    def poll_filmstrip(self):
+        self.filmstrip_polling = False
+        self.update_filmstrip()
     
     def update_preview(self, *args):
         if self.original_image is None:
@@ -420,268 +874,260 @@ class InstagramCropTool:
         # Get selected preset
         preset = self.presets[self.selected_preset.get()]
         
-        # Check if splitting is enabled and image is eligible
-        can_split = (self.split_wide_images.get() == 1 and self.max_allowed_panels >= 2)
-        
-        if can_split:
+        # A panel count kept for this image wins over the split options, as in
+        # the batch; the options themselves stay as they are for other images
+        panels = self.saved_panels()
+        if panels is not None:
+            max_panels = crop_engine.get_max_possible_panels(self.original_size, preset)
+            panel_count = panels if crop_engine.MIN_PANELS <= panels <= max_panels else 0
+        elif self.split_wide_images.get() == 1 and self.max_allowed_panels >= 2:
             # Get valid panel count
             panel_count = min(self.split_panels.get(), self.max_allowed_panels)
-            
-            # Setup split preview UI
-            self.setup_split_preview(panel_count)
-            
+        else:
+            panel_count = 0
+        can_split = panel_count > 0
+        
+        if can_split:
+            slots = [self.wide_slot] + self.panel_slots[:panel_count]
+            source_key = ("split", self.selected_preset.get(), panel_count, self.smart_split.get())
+        else:
+            slots = [self.original_slot, self.cropped_slot]
+            source_key = ("cropped", self.selected_preset.get(), self.smart_crop.get(), self.saved_crop_box())
+        self.show_preview_layout(panel_count)
+        
+        # Skip everything when neither the settings nor any canvas size changed
+        rendered_key = (source_key, tuple(slot.size() for slot in slots))
+        if rendered_key == self.rendered_key:
+            return
+        self.rendered_key = rendered_key
+        self.cancel_refinements()
+        
+        if source_key != self.preview_source_key:
+            if can_split:
+                self.preview_sources = self.split_image_preview(self.original_image, preset, panel_count)
+            else:
+                self.preview_sources = [self.crop_image_preview(self.original_image, preset)]
+            self.preview_source_key = source_key
+        
+        if can_split:
             # Show original image in top canvas
-            self.display_original_wide_preview(self.original_image, self.original_canvas)
-            
-            # Generate and show split panels
-            split_images = self.split_image_preview(self.original_image, preset, panel_count)
-            self.preview_images = []  # Clear previous references
+            self.display_original_wide_preview(self.original_image, self.wide_slot, cache_key=("wide",))
             
-            for i, img in enumerate(split_images):
-                if i < len(self.split_canvases):
-                    self.display_panel_preview(img, self.split_canvases[i], i)
+            for i, (img, slot) in enumerate(zip(self.preview_sources, slots[1:])):
+                self.display_panel_preview(img, slot, cache_key=source_key + (i,))
         else:
-            # Setup standard preview UI
-            self.setup_standard_preview()
-            
-            # Show original image preview
-            self.display_preview_image(self.original_image, self.original_canvas, self.preview_original)
-            
-            # Show cropped image preview
-            cropped_img = self.crop_image_preview(self.original_image, preset)
-            self.display_preview_image(cropped_img, self.cropped_canvas, self.preview_cropped)
+            # Show original and cropped image previews
+            self.display_preview_image(self.original_image, self.original_slot, cache_key=("original",))
+            self.display_preview_image(self.preview_sources[0], self.cropped_slot, cache_key=source_key)
+            self.draw_crop_outline()
     
     def should_split_image(self, img, preset):
         """Determine if an image should be split based on its aspect ratio and width"""
-        # Check if the format has a standard size
-        if not preset["size"]:
-            return False
-            
-        # Get image dimensions
-        width, height = img.size
-        
-        # Get standard width for selected format
-        std_width = preset["size"][0]
-        
-        # Calculate how many standard widths fit into the image
-        panels_possible = width // std_width
-        
-        # Can split if image can fit 2 or more panels
-        return panels_possible >= 2
+        return crop_engine.should_split_image(img.size, preset)
     
     def get_max_possible_panels(self, img, preset):
         """Calculate how many panels the image can be split into"""
-        if not preset["size"]:
-            return 1
-            
-        # Get image dimensions
-        width, height = img.size
-        
-        # Get standard width for selected format
-        std_width = preset["size"][0]
-        
-        # Calculate how many standard widths fit into the image
-        panels_possible = width // std_width
-        
-        # Limit to 5 panels maximum
-        return min(panels_possible, 5)
+        return crop_engine.get_max_possible_panels(img.size, preset)
     
-    def display_original_wide_preview(self, img, canvas):
+    def show_preview_photo(self, img, size, slot, position, cache_key):
+        """Show img at size in slot: cached renders at once, otherwise a fast pass now and a refined one later"""
+        key = cache_key + size
+        slot.extent = position + size
+        photo = self.preview_cache.get(key)
+        if photo is not None:
+            slot.show(photo, *position)
+            return
+        slot.show(ImageTk.PhotoImage(img.resize(size, Image.NEAREST)), *position)
+        future = self.preview_pool.submit(render_preview, img, size)
+        self.refinements.append((future, self.preview_generation, key, slot, position))
+        if not self.refine_polling:
+            self.refine_polling = True
+            self.root.after(self.refine_poll_delay, self.poll_refinements)
+    
+    def cancel_refinements(self):
+        """Drop refinements of superseded previews; ones already running are ignored when they finish"""
+        self.preview_generation += 1
+        for future, _, _, _, _ in self.refinements:
+            future.cancel()
+    
+    def poll_refinements(self):
+        """Swap in finished LANCZOS renders (PhotoImages can only be made on the Tk thread)"""
+        pending = []
+        for refinement in self.refinements:
+            future, generation, key, slot, position = refinement
+            if not future.done():
+                pending.append(refinement)
+                continue
+            if future.cancelled() or generation != self.preview_generation:
+                continue
+            try:
+                photo = ImageTk.PhotoImage(future.result())
+            except Exception as e:
+                logger.warning("Could not render preview: %s", e)
+                continue
+            self.preview_cache.put(key, photo)
+            slot.show(photo, *position)
+        self.refinements = pending
+        if pending:
+            self.root.after(self.refine_poll_delay, self.poll_refinements)
+        else:
+            self.refine_polling = False
+    
+    def display_original_wide_preview(self, img, slot, cache_key):
         """Display the original wide image in a letterbox format"""
-        # Clear canvas
-        canvas.delete("all")
-        
-        # Get canvas dimensions
-        canvas_width = canvas.winfo_width() or 400
-        canvas_height = canvas.winfo_height() or 100
-        
-        # Ensure valid dimensions
-        if canvas_width <= 1:
-            canvas_width = 400
-        if canvas_height <= 1:
-            canvas_height = 100
+        canvas_width, canvas_height = slot.size()
         
         # Calculate scaled dimensions (fit to width)
         img_width, img_height = img.size
         scale_factor = canvas_width / img_width
         new_width = canvas_width
-        new_height = int(img_height * scale_factor)
+        new_height = max(int(img_height * scale_factor), 1)
         
         # Adjust height if needed
         if new_height > canvas_height:
             scale_factor = canvas_height / new_height
-            new_width = int(new_width * scale_factor)
+            new_width = max(int(new_width * scale_factor), 1)
             new_height = canvas_height
         
-        # Resize image for display
-        img_resized = img.resize((new_width, new_height), Image.LANCZOS)
-        
-        # Convert to PhotoImage
-        photo = ImageTk.PhotoImage(img_resized)
-        self.preview_original = photo  # Keep reference
-        
         # Display in canvas center
-        x = (canvas_width - new_width) // 2
-        y = (canvas_height - new_height) // 2
-        canvas.create_image(x, y, anchor="nw", image=photo)
+        position = ((canvas_width - new_width) // 2, (canvas_height - new_height) // 2)
+        self.show_preview_photo(img, (new_width, new_height), slot, position, cache_key)
     
     def split_image_preview(self, img, preset, num_panels):
         """Split a wide image into multiple panels that follow the target aspect ratio"""
         try:
-            # Get image dimensions
-            img_width, img_height = img.size
-            
-            # Get target aspect ratio
-            target_ratio = preset["ratio"][0] / preset["ratio"][1]
-            
-            # Calculate the width of each panel based on height and target ratio
-            panel_width = int(img_height * target_ratio)
-            
-            # Calculate the standard width based on preset
-            std_panel_width = panel_width
-            if preset["size"]:
-                std_panel_width = preset["size"][0] * (img_height / preset["size"][1])
-            
-            # Determine panel width based on image width
-            total_width = img_width
-            panel_width = total_width // num_panels
-            
-            # Adjust panel width to match aspect ratio
-            new_height = int(panel_width / target_ratio)
-            if new_height < img_height:
-                # If calculated height is too small, use target aspect ratio instead
-                panel_width = int(img_height * target_ratio)
-            
-            # Calculate overlap
-            total_width_needed = panel_width * num_panels
-            
-            if total_width_needed <= img_width:
-                # No overlap needed - image is wide enough
-                overlap = 0
-                # Distribute panels evenly across the image
-                spacing = (img_width - total_width_needed) // (num_panels + 1)
-                start_offset = spacing
-            else:
-                # Need overlap - calculate how much
-                overlap_pixels = total_width_needed - img_width
-                overlap_per_panel = overlap_pixels / (num_panels - 1)
-                overlap = int(overlap_per_panel)
-                start_offset = 0
-            
-            # Create panels
-            panels = []
-            for i in range(num_panels):
-                # Calculate panel boundaries
-                left = start_offset + (i * (panel_width - overlap))
-                
-                # Ensure we don't go out of bounds
-                if left < 0:
-                    left = 0
-                if left + panel_width > img_width:
-                    left = img_width - panel_width
-                
-                right = min(left + panel_width, img_width)
-                
-                # Ensure panel has valid dimensions
-                if left >= right or right <= left:
-                    continue
-                
-                # Crop the panel
-                panel = img.crop((left, 0, right, img_height))
-                
-                # Validate panel
-                if panel.width > 0 and panel.height > 0:
-                    panels.append(panel)
-            
-            return panels
-            
+            return crop_engine.split_to_panels(img, preset, num_panels, smart=self.smart_split.get() == 1)
         except Exception as e:
-            print(f"Error in split_image_preview: {str(e)}")
+            logger.error("Error in split_image_preview: %s", e)
             # Return empty list in case of error
             return []
     
-    def display_panel_preview(self, img, canvas, index):
+    def display_panel_preview(self, img, slot, cache_key):
         """Display a panel image in the split view"""
-        # Clear canvas
-        canvas.delete("all")
-        
-        # Get canvas dimensions
-        canvas_width = canvas.winfo_width() or 150
-        canvas_height = canvas.winfo_height() or 150
-        
-        # Ensure valid dimensions
-        if canvas_width <= 1:
-            canvas_width = 150
-        if canvas_height <= 1:
-            canvas_height = 150
-        
-        # Calculate scaled dimensions
-        img_width, img_height = img.size
-        ratio = min(canvas_width / img_width, canvas_height / img_height)
-        new_width = int(img_width * ratio)
-        new_height = int(img_height * ratio)
-        
-        # Resize image for display
-        img_resized = img.resize((new_width, new_height), Image.LANCZOS)
-        
-        # Convert to PhotoImage
-        photo = ImageTk.PhotoImage(img_resized)
-        
-        # Store reference to prevent garbage collection
-        if len(self.preview_images) <= index:
-            self.preview_images.append(photo)
-        else:
-            self.preview_images[index] = photo
-        
-        # Display in canvas center
-        x = (canvas_width - new_width) // 2
-        y = (canvas_height - new_height) // 2
-        canvas.create_image(x, y, anchor="nw", image=photo)
+        self.display_preview_image(img, slot, cache_key)
     
     def crop_image_preview(self, img, preset):
-        # Create a copy of the image for preview
-        img_copy = img.copy()
-        
-        # Get target aspect ratio
-        target_ratio = preset["ratio"][0] / preset["ratio"][1]
-        
-        # Calculate current aspect ratio
-        width, height = img_copy.size
-        current_ratio = width / height
-        
-        # Determine crop box
-        if current_ratio > target_ratio:
-            # Image is wider than target, crop width
-            new_width = int(height * target_ratio)
-            left = (width - new_width) // 2
-            top = 0
-            right = left + new_width
-            bottom = height
+        box = self.saved_crop_box()
+        if box is not None:
+            box = crop_engine.scale_box(box, self.original_size, img.size)
         else:
-            # Image is taller than target, crop height
-            new_height = int(width / target_ratio)
-            left = 0
-            top = (height - new_height) // 2
-            right = width
-            bottom = top + new_height
-        
-        # Crop the image
-        return img_copy.crop((left, top, right, bottom))
-    
-    def display_preview_image(self, img, canvas, photo_ref):
-        # Clear canvas
-        canvas.delete("all")
-        
-        # Get current canvas dimensions
-        canvas.update_idletasks()  # Force geometry update
-        canvas_width = canvas.winfo_width() 
-        canvas_height = canvas.winfo_height()
-        
-        # Set fallback dimensions if canvas hasn't been properly sized yet
-        if canvas_width <= 1:
-            canvas_width = 250
-        if canvas_height <= 1:
-            canvas_height = 250
+            box = crop_engine.compute_crop_box(img.size, preset)
+            if self.smart_crop.get() == 1:
+                box = crop_saliency.saliency_box(img, box)
+        self.preview_box = box
+        return crop_engine.crop_to_preset(img, preset, box=box)
+    
+    def current_manifest(self):
+        if not self.current_image_path or self.original_size is None:
+            return None
+        return self.manifests.for_image(self.current_image_path)
+    
+    def saved_crop_box(self):
+        """Full-resolution crop box kept for the current image and preset, or None"""
+        manifest = self.current_manifest()
+        if manifest is None:
+            return None
+        box = manifest.crop_box(self.current_image_path, self.original_size, self.selected_preset.get())
+        if box is None or not crop_engine.override_box_fits(box, self.original_size,
+                                                            self.presets[self.selected_preset.get()]):
+            return None
+        return box
+    
+    def saved_panels(self):
+        """Panel count kept for the current image (0 to crop it), or None"""
+        manifest = self.current_manifest()
+        if manifest is None:
+            return None
+        return manifest.panels(self.current_image_path, self.original_size)
+    
+    def save_manifest(self, manifest, message):
+        try:
+            manifest.save()
+        except OSError as e:
+            logger.warning("Could not save crop overrides: %s", e)
+            self.status_label.config(text="Could not save the changes for this image")
+            return
+        self.status_label.config(text=message)
+    
+    def draw_crop_outline(self):
+        """Outline the crop box on the original preview"""
+        canvas = self.original_slot.canvas
+        if self.original_slot.extent is None or self.preview_box is None:
+            canvas.itemconfigure(self.crop_outline, state="hidden")
+            return
+        x, y, width, height = self.original_slot.extent
+        scale_x, scale_y = width / self.original_image.width, height / self.original_image.height
+        left, top, right, bottom = self.preview_box
+        canvas.coords(self.crop_outline, x + left * scale_x, y + top * scale_y,
+                      x + right * scale_x - 1, y + bottom * scale_y - 1)
+        canvas.itemconfigure(self.crop_outline, state="normal")
+        canvas.tag_raise(self.crop_outline)
+    
+    def start_crop_drag(self, event):
+        if self.preview_layout != 0 or self.original_slot.extent is None or self.preview_box is None:
+            return
+        box = self.saved_crop_box()
+        if box is None:
+            # Start from the box shown, at full resolution and with the exact size the engine crops
+            preset = self.presets[self.selected_preset.get()]
+            full = crop_engine.compute_crop_box(self.original_size, preset)
+            scale = self.original_size[0] / self.original_image.width
+            left = min(max(round(self.preview_box[0] * scale), 0), self.original_size[0] - (full[2] - full[0]))
+            top = min(max(round(self.preview_box[1] * scale), 0), self.original_size[1] - (full[3] - full[1]))
+            box = (left, top, left + full[2] - full[0], top + full[3] - full[1])
+        self.crop_drag = (event.x, event.y, box)
+    
+    def drag_crop(self, event):
+        """Move the crop of the current image with the mouse"""
+        if self.crop_drag is None:
+            return
+        start_x, start_y, (left, top, right, bottom) = self.crop_drag
+        scale = self.original_size[0] / self.original_slot.extent[2]
+        width, height = right - left, bottom - top
+        new_left = min(max(left + round((event.x - start_x) * scale), 0), self.original_size[0] - width)
+        new_top = min(max(top + round((event.y - start_y) * scale), 0), self.original_size[1] - height)
+        self.current_manifest().set_crop_box(self.current_image_path, self.original_size,
+                                             self.selected_preset.get(),
+                                             (new_left, new_top, new_left + width, new_top + height))
+        self.update_preview()
+    
+    def end_crop_drag(self, event):
+        if self.crop_drag is None:
+            return
+        self.crop_drag = None
+        if self.saved_crop_box() is None:
+            # A click without a drag
+            return
+        self.save_manifest(self.current_manifest(),
+                           f"Crop position kept for {os.path.basename(self.current_image_path)}")
+    
+    def save_panel_override(self):
+        """Always split the current image into the selected number of panels, or never split it"""
+        manifest = self.current_manifest()
+        if manifest is None:
+            messagebox.showinfo("Select Image", "Please select an image first")
+            return
+        panels = 0
+        if self.split_wide_images.get() == 1 and self.max_allowed_panels >= 2:
+            panels = min(self.split_panels.get(), self.max_allowed_panels)
+        manifest.set_panels(self.current_image_path, self.original_size, panels)
+        self.save_manifest(manifest, f"{f'{panels} panels' if panels else 'No split'} kept for "
+                                     f"{os.path.basename(self.current_image_path)}")
+        self.update_preview()
+    
+    def reset_overrides(self):
+        """Forget the crop position (for this preset) and panel count kept for the current image"""
+        manifest = self.current_manifest()
+        if manifest is None:
+            return
+        cleared_crop = manifest.clear_crop_box(self.current_image_path, self.selected_preset.get())
+        cleared_panels = manifest.clear_panels(self.current_image_path)
+        if cleared_crop or cleared_panels:
+            self.save_manifest(manifest, f"Reset {os.path.basename(self.current_image_path)}")
+            self.update_preview()
+    
+    def display_preview_image(self, img, slot, cache_key):
+        canvas_width, canvas_height = slot.size()
         
         # Calculate scaled dimensions to fit canvas while maintaining aspect ratio
         img_width, img_height = img.size
@@ -689,41 +1135,30 @@ class InstagramCropTool:
         new_width = max(int(img_width * ratio), 1)  # Ensure at least 1 pixel
         new_height = max(int(img_height * ratio), 1)  # Ensure at least 1 pixel
         
-        # Resize the image for display
-        img_resized = img.resize((new_width, new_height), Image.LANCZOS)
-        
-        # Convert to PhotoImage and keep reference
-        photo = ImageTk.PhotoImage(img_resized)
-        
-        # Store reference to prevent garbage collection
-        if canvas == self.original_canvas:
-            self.preview_original = photo
-        else:
-            self.preview_cropped = photo
-        
         # Display in canvas at center
-        x = (canvas_width - new_width) // 2
-        y = (canvas_height - new_height) // 2
-        canvas.create_image(x, y, anchor="nw", image=photo)
+        position = ((canvas_width - new_width) // 2, (canvas_height - new_height) // 2)
+        self.show_preview_photo(img, (new_width, new_height), slot, position, cache_key)
     
     def process_images(self):
         if not self.current_image_path:
             messagebox.showinfo("Select Image", "Please select an image first")
             return
             
+        # Offer the whole folder when one is open
+        if len(self.session_paths) > 1 and messagebox.askyesno(
+                "Process Images", f"Process all {len(self.session_paths)} images in this folder?"):
+            filenames = list(self.session_paths)
         # Ask if user wants to process the current image or select multiple images
-        response = messagebox.askyesno("Process Images", 
-                                      "Do you want to process the current image?\n\n"
-                                      "Click 'Yes' to process the current image.\n"
-                                      "Click 'No' to select multiple images.")
-        
-        if response:
+        elif messagebox.askyesno("Process Images", 
+                                 "Do you want to process the current image?\n\n"
+                                 "Click 'Yes' to process the current image.\n"
+                                 "Click 'No' to select multiple images."):
             # Process current image
             filenames = [self.current_image_path]
         else:
             # Select multiple images
             filetypes = [
-                ("Image files", "*.jpg *.jpeg *.png *.webp"),
+                ("Image files", "*.jpg *.jpeg *.png *.webp *.tif *.tiff *.bmp *.ppm *.pgm *.tga"),
                 ("All files", "*.*")
             ]
             
@@ -741,118 +1176,128 @@ class InstagramCropTool:
             self.status_label.config(text="Operation cancelled")
             return
             
-        # Print debug information
-        print(f"Output directory: {output_dir}")
-        print(f"Files to process: {filenames}")
+        logger.debug("Output directory: %s", output_dir)
+        logger.debug("Files to process: %s", filenames)
             
         # Verify output directory exists and is writable
         if not os.path.exists(output_dir):
             try:
                 os.makedirs(output_dir)
-                print(f"Created directory: {output_dir}")
+                logger.info("Created directory: %s", output_dir)
             except Exception as e:
                 error_msg = f"Cannot create output directory: {str(e)}"
-                print(error_msg)
+                logger.error(error_msg)
                 messagebox.showerror("Error", error_msg)
                 return
                 
         if not os.access(output_dir, os.W_OK):
             error_msg = f"Cannot write to the output directory: {output_dir}"
-            print(error_msg)
+            logger.error(error_msg)
             messagebox.showerror("Error", error_msg)
             return
             
-        preset = self.presets[self.selected_preset.get()]
-        print(f"Using preset: {self.selected_preset.get()}, ratio: {preset['ratio']}, size: {preset['size']}")
-        
-        # Progress bar setup
-        progress_window = Tk()
-        progress_window.title("Processing Images")
-        progress_window.geometry("300x150")
-        progress_window.configure(bg="#f0f0f0")
-        
-        Label(progress_window, text="Processing images...", font=("Helvetica", 10), bg="#f0f0f0").pack(pady=(20, 10))
-        
-        progress = ttk.Progressbar(progress_window, orient=HORIZONTAL, length=250, mode='determinate')
-        progress.pack(pady=10, padx=20)
-        
-        status_text = StringVar()
-        status_text.set(f"Processing 0/{len(filenames)}")
-        status_label = Label(progress_window, textvariable=status_text, font=("Helvetica", 9), bg="#f0f0f0")
-        status_label.pack(pady=10)
-        
-        progress_window.update()
+        engine = self.make_engine()
+        logger.info("Using preset: %s, ratio: %s, size: %s", engine.preset_name, engine.preset['ratio'],
+                    engine.preset['size'])
         
-        # Process images
-        processed = 0
-        failed = 0
-        total_images = 0  # Total including split panels
-        progress["maximum"] = len(filenames)
-        
-        for i, filename in enumerate(filenames):
+        runner = BatchRunner(engine, workers=self.workers, cache=OutputCache(self.output_cache_dir))
+        self.start_batch(runner, list(filenames), output_dir)
+    
+    def start_batch(self, runner, filenames, output_dir):
+        """Run a batch on a worker thread and follow it from the Tk loop"""
+        self.batch_queue = queue.Queue()
+        self.batch_cancel = threading.Event()
+        self.batch_summary = BatchSummary(len(filenames))
+        self.batch_failures = []
+        self.batch_output_dir = output_dir
+        self.batch_started = time.monotonic()
+        self.batch_plan = None
+        self.batch_outputs_done = 0
+        
+        self.progress_window = ProgressWindow(self.root, len(filenames), self.batch_cancel.set)
+        self.process_btn.config(state="disabled")
+        self.status_label.config(text=f"Processing {len(filenames)} images...")
+        
+        def worker():
             try:
-                print(f"Processing file: {filename}")
-                # Check if we should split the image
-                if self.split_wide_images.get() == 1:
-                    print("Split mode enabled")
-                    img = Image.open(filename)
-                    max_panels = self.get_max_possible_panels(img, preset)
-                    print(f"Max possible panels: {max_panels}")
-                    
-                    if max_panels >= 2 and self.split_panels.get() <= max_panels:
-                        # Process as split image
-                        num_panels = min(self.split_panels.get(), max_panels)
-                        print(f"Splitting into {num_panels} panels")
-                        output_paths = self.process_split_image(filename, output_dir, preset, num_panels)
-                        print(f"Split output paths: {output_paths}")
-                        if output_paths and len(output_paths) > 0:
-                            processed += 1
-                            total_images += len(output_paths)
-                        else:
-                            print("No output paths returned from process_split_image")
-                            failed += 1
+                # Header-only scan first so progress counts output images
+                plan = plan_batch(runner.engine, filenames)
+                self.batch_queue.put(("plan", None, plan))
+                for i, result in runner.iter_results(filenames, output_dir, self.batch_cancel, plan):
+                    self.batch_queue.put(("result", i, result))
+            except Exception as e:
+                self.batch_queue.put(("error", None, str(e)))
+            self.batch_queue.put(("done", None, None))
+        
+        self.batch_thread = threading.Thread(target=worker, daemon=True)
+        self.batch_thread.start()
+        self.root.after(self.batch_poll_delay, self.poll_batch)
+    
+    def poll_batch(self):
+        """Drain progress events posted by the batch worker"""
+        done = False
+        summary = self.batch_summary
+        try:
+            while True:
+                kind, index, payload = self.batch_queue.get_nowait()
+                if kind == "plan":
+                    self.batch_plan = payload
+                    self.progress_window.set_plan(payload)
+                    # Measure throughput from when processing really starts
+                    self.batch_started = time.monotonic()
+                elif kind == "result":
+                    logger.debug("Processed file: %s, output paths: %s", payload.source, payload.output_paths)
+                    summary.add(payload)
+                    if payload.ok:
+                        self.batch_outputs_done += len(payload.output_paths)
                     else:
-                        # Process as normal image
-                        print("Image not wide enough for splitting, processing as normal")
-                        output_path = self.crop_image(filename, output_dir, preset)
-                        print(f"Normal output path: {output_path}")
-                        if output_path:
-                            processed += 1
-                            total_images += 1
-                        else:
-                            print("No output path returned from crop_image")
-                            failed += 1
+                        # Count the outputs this file would have produced so the bar still reaches the end
+                        self.batch_outputs_done += self.batch_plan.items[index].outputs
+                        self.batch_failures.append(f"{os.path.basename(payload.source)}: {payload.error}")
+                elif kind == "error":
+                    logger.error("Batch stopped: %s", payload)
+                    self.batch_failures.append(payload)
                 else:
-                    # Process as normal image
-                    print("Normal crop mode")
-                    output_path = self.crop_image(filename, output_dir, preset)
-                    print(f"Output path: {output_path}")
-                    if output_path:
-                        processed += 1
-                        total_images += 1
-                    else:
-                        print("No output path returned from crop_image")
-                        failed += 1
-            except Exception as e:
-                error_msg = f"Error processing {filename}: {str(e)}"
-                print(error_msg)
-                failed += 1
-                
-            progress["value"] = i + 1
-            status_text.set(f"Processing {i+1}/{len(filenames)}")
-            progress_window.update()
+                    done = True
+                    break
+        except queue.Empty:
+            pass
+        
+        self.progress_window.update_progress(summary.processed + summary.failed, self.batch_outputs_done,
+                                             time.monotonic() - self.batch_started)
+        
+        if done:
+            self.finish_batch()
+        else:
+            self.root.after(self.batch_poll_delay, self.poll_batch)
+    
+    def finish_batch(self):
+        """Close the progress window and report the batch outcome"""
+        self.progress_window.destroy()
+        self.process_btn.config(state="normal")
         
-        progress_window.destroy()
+        summary = self.batch_summary
+        processed, failed, total_images = summary.processed, summary.failed, summary.total_images
+        output_dir = self.batch_output_dir
+        cancelled = self.batch_cancel.is_set()
         
         # Show completion message
         completion_msg = ""
+        if cancelled:
+            completion_msg = f"Processing cancelled after {processed + failed} of {summary.total} images.\n"
         if failed > 0:
-            completion_msg = f"Successfully processed {processed} of {len(filenames)} images.\n{failed} images could not be processed.\nTotal output images: {total_images}"
+            completion_msg += f"Successfully processed {processed} of {summary.total} images.\n{failed} images could not be processed.\nTotal output images: {total_images}"
+            completion_msg += "\n\n" + "\n".join(self.batch_failures[:5])
+            if len(self.batch_failures) > 5:
+                completion_msg += f"\n... and {len(self.batch_failures) - 5} more"
         else:
-            completion_msg = f"Successfully processed {processed} images.\nTotal output images: {total_images}"
+            completion_msg += f"Successfully processed {processed} images.\nTotal output images: {total_images}"
+        if summary.cached:
+            completion_msg += f"\n{summary.cached} unchanged images were restored from the cache."
             
-        print(completion_msg)
-        messagebox.showinfo("Processing Complete", completion_msg)
+        summary.elapsed = time.monotonic() - self.batch_started
+        log_summary(summary)
+        messagebox.showinfo("Processing Cancelled" if cancelled else "Processing Complete", completion_msg)
         
         # Open output directory
         try:
@@ -863,252 +1308,55 @@ class InstagramCropTool:
                     import subprocess
                     subprocess.Popen(['xdg-open', output_dir])
         except Exception as e:
-            print(f"Could not open output directory: {str(e)}")
+            logger.warning("Could not open output directory: %s", e)
         
         self.status_label.config(text=f"Successfully processed {processed} images")
     
+    def make_engine(self):
+        """Build a headless engine from the current GUI settings"""
+        return CropEngine(self.selected_preset.get(),
+                          split_wide_images=self.split_wide_images.get() == 1,
+                          split_panels=self.split_panels.get(),
+                          presets=self.presets,
+                          encoder=self.selected_encoder.get(),
+                          smart_crop=self.smart_crop.get() == 1,
+                          smart_split=self.smart_split.get() == 1)
+    
     def crop_image(self, image_path, output_dir, preset):
         try:
-            print(f"Starting crop_image for {image_path}")
-            # Open the image
-            img = Image.open(image_path)
-            print(f"Image opened: {img.size}")
-            
-            # Get target aspect ratio
-            target_ratio = preset["ratio"][0] / preset["ratio"][1]
-            
-            # Calculate current aspect ratio
-            width, height = img.size
-            current_ratio = width / height
-            print(f"Target ratio: {target_ratio}, Current ratio: {current_ratio}")
-            
-            # Determine crop box
-            if current_ratio > target_ratio:
-                # Image is wider than target, crop width
-                new_width = int(height * target_ratio)
-                left = (width - new_width) // 2
-                top = 0
-                right = left + new_width
-                bottom = height
-            else:
-                # Image is taller than target, crop height
-                new_height = int(width / target_ratio)
-                left = 0
-                top = (height - new_height) // 2
-                right = width
-                bottom = top + new_height
-                
-            print(f"Crop box: ({left}, {top}, {right}, {bottom})")
-            
-            # Validate crop box
-            if left >= right or top >= bottom:
-                # Invalid crop dimensions
-                error_msg = f"Invalid crop dimensions: ({left}, {top}, {right}, {bottom})"
-                print(error_msg)
-                messagebox.showerror("Error", error_msg)
-                return None
-            
-            # Crop the image
-            cropped_img = img.crop((left, top, right, bottom))
-            print(f"Cropped image: {cropped_img.size}")
-            
-            # Validate cropped image
-            if cropped_img.width <= 0 or cropped_img.height <= 0:
-                error_msg = f"Invalid cropped dimensions: {cropped_img.width}x{cropped_img.height}"
-                print(error_msg)
-                messagebox.showerror("Error", error_msg)
-                return None
-            
-            # Resize if size is specified
-            if preset["size"]:
-                print(f"Resizing to {preset['size']}")
-                cropped_img = cropped_img.resize(preset["size"], Image.LANCZOS)
-            
-            # Save the cropped image
-            filename = os.path.basename(image_path)
-            name, ext = os.path.splitext(filename)
-            format_name = self.selected_preset.get().replace(" ", "").replace("(", "").replace(")", "").replace(":", "-")
-            new_filename = f"{name}_{format_name}{ext}"
-            output_path = os.path.join(output_dir, new_filename)
-            print(f"Output path: {output_path}")
-            
-            # Ensure format is correct based on extension
-            save_format = ext.lower().replace('.', '')
-            if save_format == 'jpg':
-                save_format = 'JPEG'
-            elif save_format == 'jpeg':
-                save_format = 'JPEG'
-            
-            print(f"Saving with format: {save_format}")
-            
-            # Save with quality parameter for JPEG
-            if save_format.upper() == 'JPEG':
-                cropped_img.save(output_path, format=save_format.upper(), quality=95)
-            else:
-                # For non-JPEG formats
-                if save_format.upper() in ['PNG', 'GIF', 'BMP', 'WEBP']:
-                    cropped_img.save(output_path, format=save_format.upper())
-                else:
-                    # Default to PNG if format not recognized
-                    print(f"Unrecognized format: {save_format}, defaulting to PNG")
-                    new_output_path = os.path.splitext(output_path)[0] + ".png"
-                    cropped_img.save(new_output_path, format="PNG")
-                    output_path = new_output_path
-            
-            # Verify the file was created and has content
-            if not os.path.exists(output_path):
-                error_msg = f"Error: Output file was not created: {output_path}"
-                print(error_msg)
-                messagebox.showerror("Error", error_msg)
-                return None
-                
-            if os.path.getsize(output_path) == 0:
-                error_msg = f"Error: Output file is empty: {output_path}"
-                print(error_msg)
-                messagebox.showerror("Error", error_msg)
-                # Try saving again with a different method
-                try:
-                    print("Trying alternative save method...")
-                    # Convert to RGB if needed (to avoid transparency issues)
-                    if cropped_img.mode in ['RGBA', 'LA']:
-                        print(f"Converting from {cropped_img.mode} to RGB")
-                        rgb_img = Image.new("RGB", cropped_img.size, (255, 255, 255))
-                        rgb_img.paste(cropped_img, mask=cropped_img.split()[3] if cropped_img.mode == 'RGBA' else None)
-                        cropped_img = rgb_img
-                    
-                    # Try with a different name and format
-                    backup_path = os.path.join(output_dir, f"{name}_backup.jpg")
-                    print(f"Saving backup to: {backup_path}")
-                    cropped_img.save(backup_path, format="JPEG", quality=95)
-                    return backup_path
-                except Exception as e:
-                    print(f"Alternative save failed: {e}")
-                    return None
-                
-            print(f"File saved successfully: {output_path} ({os.path.getsize(output_path)} bytes)")
-            return output_path
-            
+            engine = self.make_engine()
+            engine.preset = preset
+            return engine.crop(image_path, output_dir)
         except Exception as e:
             error_msg = f"Error processing {image_path}: {str(e)}"
-            print(error_msg)
-            import traceback
-            traceback.print_exc()
+            logger.error(error_msg)
             messagebox.showerror("Error", error_msg)
             return None
             
     def process_split_image(self, image_path, output_dir, preset, num_panels):
         """Process a wide image by splitting it into multiple panels"""
         try:
-            print(f"Starting process_split_image for {image_path}")
-            # Open the image
-            img = Image.open(image_path)
-            print(f"Image opened: {img.size}")
-            
-            # Check if image is wide enough for requested number of panels
-            max_panels = self.get_max_possible_panels(img, preset)
-            if num_panels > max_panels:
-                # Adjust to maximum possible
-                num_panels = max_panels
-                print(f"Adjusted to maximum possible panels: {num_panels}")
-            
-            # Split the image into panels
-            panels = self.split_image_preview(img, preset, num_panels)
-            print(f"Split into {len(panels)} panels")
-            
-            # Get base filename
-            filename = os.path.basename(image_path)
-            name, ext = os.path.splitext(filename)
-            format_name = self.selected_preset.get().replace(" ", "").replace("(", "").replace(")", "").replace(":", "-")
-            
-            # Save each panel
-            output_paths = []
-            
-            for i, panel in enumerate(panels):
-                try:
-                    print(f"Processing panel {i+1} size: {panel.size}")
-                    # Validate the panel image
-                    if panel.width <= 0 or panel.height <= 0:
-                        print(f"Invalid panel dimensions: {panel.width}x{panel.height}")
-                        continue
-                        
-                    # Resize if size is specified
-                    if preset["size"]:
-                        print(f"Resizing panel to {preset['size']}")
-                        panel = panel.resize(preset["size"], Image.LANCZOS)
-                    
-                    # Save the panel
-                    new_filename = f"{name}_{format_name}_panel{i+1}of{num_panels}{ext}"
-                    output_path = os.path.join(output_dir, new_filename)
-                    print(f"Panel output path: {output_path}")
-                    
-                    # Ensure format is correct based on extension
-                    save_format = ext.lower().replace('.', '')
-                    if save_format == 'jpg':
-                        save_format = 'JPEG'
-                    elif save_format == 'jpeg':
-                        save_format = 'JPEG'
-                    
-                    print(f"Saving panel with format: {save_format}")
-                    
-                    # Save with quality parameter for JPEG
-                    if save_format.upper() == 'JPEG':
-                        panel.save(output_path, format=save_format.upper(), quality=95)
-                    else:
-                        # For non-JPEG formats
-                        if save_format.upper() in ['PNG', 'GIF', 'BMP', 'WEBP']:
-                            panel.save(output_path, format=save_format.upper())
-                        else:
-                            # Default to PNG if format not recognized
-                            print(f"Unrecognized format: {save_format}, defaulting to PNG")
-                            new_output_path = os.path.splitext(output_path)[0] + ".png"
-                            panel.save(new_output_path, format="PNG")
-                            output_path = new_output_path
-                    
-                    # Verify the file was created and has content
-                    if not os.path.exists(output_path):
-                        print(f"Error: Panel file was not created: {output_path}")
-                        continue
-                        
-                    if os.path.getsize(output_path) == 0:
-                        print(f"Error: Panel file is empty: {output_path}")
-                        # Try saving again with a different method
-                        try:
-                            print("Trying alternative save method for panel...")
-                            # Convert to RGB if needed
-                            if panel.mode in ['RGBA', 'LA']:
-                                print(f"Converting from {panel.mode} to RGB")
-                                rgb_img = Image.new("RGB", panel.size, (255, 255, 255))
-                                rgb_img.paste(panel, mask=panel.split()[3] if panel.mode == 'RGBA' else None)
-                                panel = rgb_img
-                            
-                            # Try with a different name and format
-                            backup_path = os.path.join(output_dir, f"{name}_panel{i+1}_backup.jpg")
-                            print(f"Saving backup to: {backup_path}")
-                            panel.save(backup_path, format="JPEG", quality=95)
-                            output_paths.append(backup_path)
-                        except Exception as e:
-                            print(f"Alternative panel save failed: {e}")
-                    else:
-                        print(f"Panel saved successfully: {output_path} ({os.path.getsize(output_path)} bytes)")
-                        output_paths.append(output_path)
-                        
-                except Exception as e:
-                    print(f"Error saving panel {i+1}: {str(e)}")
-                    import traceback
-                    traceback.print_exc()
-            
-            print(f"Total panels saved: {len(output_paths)}")
-            return output_paths
-            
+            engine = self.make_engine()
+            engine.preset = preset
+            return engine.split(image_path, output_dir, num_panels)
         except Exception as e:
             error_msg = f"Error in process_split_image: {str(e)}"
-            print(error_msg)
-            import traceback
-            traceback.print_exc()
+            logger.error(error_msg)
             messagebox.showerror("Error", f"Could not process split image: {str(e)}")
             return []
 
 def main():
+    # Needed for the process pool in frozen (PyInstaller) Windows builds
+    multiprocessing.freeze_support()
+    
+    # Any command-line arguments switch to headless batch mode
+    if len(sys.argv) > 1:
+        import crop_cli
+        sys.exit(crop_cli.main(sys.argv[1:]))
+    
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+    logging.getLogger("instagram_crop").setLevel(logging.INFO)
+    
     root = Tk()
     app = InstagramCropTool(root)
     root.mainloop()
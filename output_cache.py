@@ -0,0 +1,226 @@
+"""On-disk cache of finished outputs so re-runs skip unchanged inputs.
+
+Entries are keyed by the input (path, size and mtime by default, or a hash
+of its content) together with everything in the engine that changes the
+output bytes. On a hit the cached files are hard-linked (or copied across
+devices) into the output directory instead of decoding, cropping and
+encoding the image again. The cache keeps its own copy of every output and
+is trimmed least-recently-used first once it grows past max_bytes.
+
+The index is only touched by the process running the batch (workers never
+see the cache), so no locking is needed within one run.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+# Bump when the engine changes in a way that alters output for the same settings
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+INDEX_FILENAME = "index.json"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+logger = logging.getLogger("instagram_crop.cache")
+
+
+def default_cache_dir():
+    """Per-user cache directory for the tool"""
+    if os.name == 'nt':
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "InstagramCropTool", "cache")
+    if sys.platform == "darwin":
+        return os.path.expanduser("~/Library/Caches/InstagramCropTool")
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "instagram_crop")
+
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Hard-link src to dst, replacing dst; copy when linking isn't possible"""
+    tmp = dst + ".tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def entry_bytes(entry):
+    return sum(item["size"] for item in entry["files"])
+
+
+class OutputCache:
+    """Size-bounded cache of engine outputs"""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, use_hash=False):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.max_bytes = max_bytes
+        self.use_hash = use_hash
+        self.index_path = os.path.join(cache_dir, INDEX_FILENAME)
+        self.entries = self._load_index()
+        # Kept up to date by store() and _remove() so evicting doesn't walk every entry
+        self._total_bytes = sum(entry_bytes(entry) for entry in self.entries.values())
+        # realpath -> (size, mtime_ns, digest) from lookup(), reused by store()
+        # so --cache-hash reads each input once
+        self._digests = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+            if data.get("version") == CACHE_VERSION:
+                return data.get("entries", {})
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def save(self):
+        """Write the index back to disk if it changed"""
+        if not self.dirty:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": CACHE_VERSION, "entries": self.entries}, f)
+        os.replace(tmp, self.index_path)
+        self.dirty = False
+
+    def key_for(self, path, engine):
+        """Cache key for an input file under the engine's current settings"""
+        st = os.stat(path)
+        realpath = os.path.realpath(path)
+        if self.use_hash:
+            known = self._digests.get(realpath)
+            if known is not None and known[:2] == (st.st_size, st.st_mtime_ns):
+                digest = known[2]
+            else:
+                digest = file_digest(path)
+                self._digests[realpath] = (st.st_size, st.st_mtime_ns, digest)
+            source_id = {"hash": digest}
+        else:
+            source_id = {"path": realpath, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        payload = json.dumps({"source": source_id, "settings": engine.settings_key(path)}, sort_keys=True)
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=20).hexdigest()
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def lookup(self, path, output_dir, engine):
+        """Restore cached outputs for path into output_dir. Returns the output paths, or None on a miss."""
+        try:
+            key = self.key_for(path, engine)
+        except OSError:
+            return None
+        entry = self.entries.get(key)
+        if entry is None:
+            # Keep the digest for store()
+            self.misses += 1
+            return None
+        self._digests.pop(os.path.realpath(path), None)
+
+        base = os.path.splitext(os.path.basename(path))[0]
+        output_paths = []
+        for item in entry["files"]:
+            obj = os.path.join(self.objects_dir, item["object"])
+            try:
+                st = os.stat(obj)
+            except OSError:
+                st = None
+            if st is None or st.st_size != item["size"] or st.st_mtime_ns != item["mtime_ns"]:
+                # Object missing or modified through a hard link; drop the entry
+                self._remove(key)
+                self.misses += 1
+                return None
+            output_path = os.path.join(output_dir, base + item["suffix"])
+            try:
+                if not os.path.exists(output_path) or not os.path.samefile(obj, output_path):
+                    link_or_copy(obj, output_path)
+            except OSError:
+                # Let the engine render it and report any real problem
+                self.misses += 1
+                return None
+            output_paths.append(output_path)
+
+        entry["last_used"] = time.time()
+        self.dirty = True
+        self.hits += 1
+        logger.debug("Cache hit for %s", path)
+        return output_paths
+
+    def store(self, path, output_paths, engine):
+        """Keep copies of a finished item's outputs"""
+        try:
+            key = self.key_for(path, engine)
+        except OSError:
+            return
+        finally:
+            self._digests.pop(os.path.realpath(path), None)
+        base = os.path.splitext(os.path.basename(path))[0]
+
+        files = []
+        try:
+            os.makedirs(os.path.join(self.objects_dir, key[:2]), exist_ok=True)
+            for i, output_path in enumerate(output_paths):
+                name = os.path.basename(output_path)
+                if not name.startswith(base):
+                    return
+                ext = os.path.splitext(name)[1]
+                obj_name = os.path.join(key[:2], f"{key}_{i}{ext}")
+                obj = os.path.join(self.objects_dir, obj_name)
+                # The cache owns a separate copy so editing an output can't change it
+                shutil.copyfile(output_path, obj)
+                st = os.stat(obj)
+                files.append({"suffix": name[len(base):], "object": obj_name,
+                              "size": st.st_size, "mtime_ns": st.st_mtime_ns})
+        except OSError as e:
+            # A full or read-only cache must not fail the batch
+            logger.warning("Could not cache outputs of %s: %s", path, e)
+            return
+
+        old = self.entries.get(key)
+        if old is not None:
+            self._total_bytes -= entry_bytes(old)
+        self.entries[key] = {"files": files, "last_used": time.time()}
+        self._total_bytes += entry_bytes(self.entries[key])
+        self.dirty = True
+        self.evict()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self._total_bytes -= entry_bytes(entry)
+        for item in entry["files"]:
+            try:
+                os.remove(os.path.join(self.objects_dir, item["object"]))
+            except OSError:
+                pass
+        self.dirty = True
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        if self._total_bytes <= self.max_bytes:
+            return
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["last_used"]):
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._remove(key)
@@ -0,0 +1,269 @@
+"""Background decoding of preview proxies and filmstrip thumbnails for the GUI.
+
+A proxy is the screen-sized copy of an image that every crop and split
+preview is derived from. Proxies are decoded on a small thread pool (JPEG
+draft decoding, resize and most of decoding release the GIL) and kept in a
+least-recently-used cache bounded by their pixel memory, so the images next
+to the current one can be prefetched and shown without waiting. Thumbnails
+have their own pool so filling the filmstrip never delays the current image.
+
+With a ThumbCache, proxies and thumbnails are read from and written to the
+persistent cache, so images seen in an earlier session are not decoded again.
+
+Nothing here touches Tk: results are plain PIL images, and the GUI turns
+them into PhotoImages on its own thread.
+"""
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import crop_engine
+from thumb_cache import exif_orientation, split_eligibility
+
+# Longest side of filmstrip thumbnails
+THUMB_SIZE = 80
+
+# Memory kept for decoded proxies (the current image is held by the GUI itself)
+DEFAULT_MEMORY_BUDGET = 512 * 1024 ** 2
+
+# Thumbnails are tiny; this many are kept (about 20 KB each)
+MAX_THUMBNAILS = 2000
+
+# Proxies that decode faster than this (e.g. JPEGs, thanks to draft decoding)
+# are not worth storing in the persistent cache
+PROXY_CACHE_MIN_SECONDS = 0.2
+
+# Images on each side of the current one that are decoded ahead of time
+PREFETCH_RADIUS = 2
+
+PROXY_WORKERS = 2
+THUMB_WORKERS = 2
+
+logger = logging.getLogger("instagram_crop.preview")
+
+
+def image_bytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+def load_proxy(path, screen_size):
+    """Decode path into a proxy of at most twice the screen size.
+
+    Returns (proxy, full-resolution size, EXIF orientation). Previews never
+    need more than the screen's pixels, so JPEGs decode at a reduced scale
+    and everything else is shrunk.
+    """
+    img = Image.open(path)
+    full_size = img.size
+    orientation = exif_orientation(img)
+    img.draft(img.mode, screen_size)
+    proxy_side = max(screen_size) * 2
+    img.thumbnail((proxy_side, proxy_side), Image.LANCZOS, reducing_gap=crop_engine.DECODE_REDUCING_GAP)
+    # thumbnail() leaves images that are already small enough undecoded
+    img.load()
+    return img, full_size, orientation
+
+
+def make_thumbnail(img, size=THUMB_SIZE):
+    """Shrink img (freshly opened or a copy; it is changed in place) to a filmstrip thumbnail"""
+    img.draft("RGB", (size, size))
+    img.thumbnail((size, size), Image.BILINEAR, reducing_gap=crop_engine.DECODE_REDUCING_GAP)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    return img
+
+
+class PreviewLoader:
+    """Decode, cache and prefetch preview proxies and thumbnails of a list of images"""
+
+    def __init__(self, screen_size, memory_budget=DEFAULT_MEMORY_BUDGET, thumb_size=THUMB_SIZE,
+                 prefetch_radius=PREFETCH_RADIUS, cache=None):
+        self.screen_size = screen_size
+        self.cache = cache
+        self.memory_budget = memory_budget
+        self.thumb_size = thumb_size
+        self.prefetch_radius = prefetch_radius
+        self.proxy_pool = ThreadPoolExecutor(max_workers=PROXY_WORKERS)
+        self.thumb_pool = ThreadPoolExecutor(max_workers=THUMB_WORKERS)
+        # Reentrant: done callbacks run on the submitting thread when a future is already finished
+        self.lock = threading.RLock()
+        # path -> (proxy, full size), least recently used first
+        self.proxies = collections.OrderedDict()
+        self.proxy_bytes = 0
+        self.thumbnails = collections.OrderedDict()
+        # path -> maximum panel count per preset, known along with the thumbnail
+        self.panel_counts = {}
+        # path -> future, for work queued or running
+        self.proxy_futures = {}
+        self.thumb_futures = {}
+        # Paths whose thumbnail could not be made; they are not retried
+        self.failed_thumbnails = set()
+
+    def get(self, path):
+        """Cached (proxy, full size) of path, or None"""
+        with self.lock:
+            entry = self.proxies.get(path)
+            if entry is not None:
+                self.proxies.move_to_end(path)
+            return entry
+
+    def _store(self, path, entry):
+        with self.lock:
+            old = self.proxies.pop(path, None)
+            if old is not None:
+                self.proxy_bytes -= image_bytes(old[0])
+            self.proxies[path] = entry
+            self.proxy_bytes += image_bytes(entry[0])
+            # Always keep the newest entry, even if it alone exceeds the budget
+            while self.proxy_bytes > self.memory_budget and len(self.proxies) > 1:
+                _, (evicted, _) = self.proxies.popitem(last=False)
+                self.proxy_bytes -= image_bytes(evicted)
+
+    def _load(self, path):
+        entry = self.cache.proxy(path) if self.cache is not None else None
+        if entry is None:
+            start = time.perf_counter()
+            proxy, full_size, orientation = load_proxy(path, self.screen_size)
+            entry = (proxy, full_size)
+            if self.cache is not None:
+                slow = time.perf_counter() - start >= PROXY_CACHE_MIN_SECONDS
+                self.cache.put(path, full_size, orientation, proxy=proxy if slow else None)
+        self._store(path, entry)
+        return entry
+
+    def load(self, path):
+        """(proxy, full size) of path, decoding it on the calling thread if it isn't cached or queued"""
+        entry = self.get(path)
+        if entry is not None:
+            return entry
+        with self.lock:
+            future = self.proxy_futures.get(path)
+        if future is not None and not future.cancel():
+            # Already being decoded; wait for that instead of decoding twice
+            return future.result()
+        return self._load(path)
+
+    def request(self, path):
+        """Future resolving to (proxy, full size) of path"""
+        with self.lock:
+            future = self.proxy_futures.get(path)
+            if future is None or future.cancelled():
+                future = self.proxy_pool.submit(self._load, path)
+                self.proxy_futures[path] = future
+                future.add_done_callback(lambda f, path=path: self._forget(self.proxy_futures, path, f))
+            return future
+
+    def prefetch(self, paths, index):
+        """Decode the neighbours of paths[index] ahead of time; older prefetches that are still queued are dropped"""
+        wanted = set()
+        for offset in range(1, self.prefetch_radius + 1):
+            for i in (index + offset, index - offset):
+                if 0 <= i < len(paths):
+                    wanted.add(paths[i])
+        wanted.add(paths[index])
+        with self.lock:
+            queued = list(self.proxy_futures.items())
+        for path, future in queued:
+            if path not in wanted:
+                future.cancel()
+        # Nearest first, so the next image is ready before the one after it
+        for offset in range(1, self.prefetch_radius + 1):
+            for i in (index + offset, index - offset):
+                if 0 <= i < len(paths) and self.get(paths[i]) is None:
+                    self.request(paths[i])
+
+    def thumbnail(self, path):
+        """Cached thumbnail of path, or None"""
+        with self.lock:
+            return self.thumbnails.get(path)
+
+    def thumbnail_failed(self, path):
+        """True when the thumbnail of path could not be made (unreadable or missing file)"""
+        with self.lock:
+            return path in self.failed_thumbnails
+
+    def max_panels(self, path):
+        """Maximum panel count per preset name of path once its thumbnail is made, or None"""
+        with self.lock:
+            return self.panel_counts.get(path)
+
+    def _make_thumbnail(self, path):
+        thumb = self.cache.thumbnail(path) if self.cache is not None else None
+        if thumb is not None:
+            # Stored with the thumbnail, so the original isn't opened at all
+            metadata = self.cache.metadata(path)
+            panels = metadata["panels"] if metadata else None
+        else:
+            entry = self.get(path)
+            if entry is not None:
+                full_size = entry[1]
+                thumb = make_thumbnail(entry[0].copy(), self.thumb_size)
+                orientation = None
+            else:
+                img = Image.open(path)
+                full_size, orientation = img.size, exif_orientation(img)
+                thumb = make_thumbnail(img, self.thumb_size)
+            panels = split_eligibility(full_size)
+            if self.cache is not None:
+                if orientation is None:
+                    # The proxy was cached with its orientation; keep it
+                    metadata = self.cache.metadata(path)
+                    orientation = metadata["orientation"] if metadata else 1
+                self.cache.put(path, full_size, orientation, thumbnail=thumb)
+        with self.lock:
+            self.thumbnails[path] = thumb
+            self.panel_counts[path] = panels
+            while len(self.thumbnails) > MAX_THUMBNAILS:
+                evicted, _ = self.thumbnails.popitem(last=False)
+                self.panel_counts.pop(evicted, None)
+        return thumb
+
+    def request_thumbnail(self, path):
+        """Future resolving to the thumbnail of path"""
+        with self.lock:
+            future = self.thumb_futures.get(path)
+            if future is None or future.cancelled():
+                future = self.thumb_pool.submit(self._make_thumbnail, path)
+                self.thumb_futures[path] = future
+                future.add_done_callback(lambda f, path=path: self._forget(self.thumb_futures, path, f))
+            return future
+
+    def cancel_thumbnails(self, keep):
+        """Drop queued thumbnails whose path is not in keep (e.g. scrolled out of view)"""
+        with self.lock:
+            queued = list(self.thumb_futures.items())
+        for path, future in queued:
+            if path not in keep:
+                future.cancel()
+
+    def _forget(self, futures, path, future):
+        failed = not future.cancelled() and future.exception() is not None
+        with self.lock:
+            if futures.get(path) is future:
+                del futures[path]
+            if failed and futures is self.thumb_futures:
+                self.failed_thumbnails.add(path)
+        if failed:
+            logger.warning("Could not load preview of %s: %s", path, future.exception())
+
+    def clear(self):
+        """Forget everything, e.g. when another folder is opened"""
+        with self.lock:
+            queued = list(self.proxy_futures.values()) + list(self.thumb_futures.values())
+        for future in queued:
+            future.cancel()
+        with self.lock:
+            self.proxies.clear()
+            self.proxy_bytes = 0
+            self.thumbnails.clear()
+            self.panel_counts.clear()
+            self.failed_thumbnails.clear()
+
+    def close(self):
+        self.clear()
+        self.proxy_pool.shutdown(wait=False)
+        self.thumb_pool.shutdown(wait=False)
@@ -0,0 +1,194 @@
+"""Region reads for uncompressed rasters without decoding the whole image.
+
+Pillow describes uncompressed TIFF, BMP, PPM/PGM and TGA pixel data as
+"raw" tiles: a file offset, a raw pixel layout and a row stride. For those
+files a crop box can be read straight from disk row by row, so cutting a
+panel out of a huge panorama only ever holds that panel (plus one band of
+rows) in memory. Compressed formats have no such layout and return None
+from raw_layout(); callers fall back to a normal decode.
+
+Where the file can be memory-mapped (map_file()), regions are decoded
+straight from the mapping with the row stride: no per-row reads or joined
+buffers, only the pages under the crop box are touched, and those are
+released again once decoded.
+"""
+import mmap
+
+from PIL import Image
+
+# Bits per pixel of the raw layouts we know how to slice. Sub-byte layouts
+# (1-bit, 4-bit) are left out because their columns don't start on bytes.
+RAWMODE_BITS = {
+    "L": 8, "P": 8,
+    "LA": 16, "I;16": 16, "I;16B": 16, "I;16L": 16,
+    "RGB": 24, "BGR": 24,
+    "RGBA": 32, "BGRA": 32, "RGBX": 32, "BGRX": 32, "CMYK": 32,
+    "I": 32, "I;32": 32, "F": 32, "F;32F": 32,
+}
+
+# Rows read and pasted at a time when assembling a region
+BAND_ROWS = 256
+
+
+class RawStrip:
+    """A run of full-width rows stored uncompressed at a file offset"""
+
+    def __init__(self, top, bottom, offset, rawmode, stride, orientation, bytes_per_pixel):
+        self.top = top
+        self.bottom = bottom
+        self.offset = offset
+        self.rawmode = rawmode
+        self.stride = stride
+        self.orientation = orientation
+        self.bytes_per_pixel = bytes_per_pixel
+
+    def row_offset(self, y):
+        """File offset of image row y, which must lie inside this strip"""
+        row = y - self.top
+        if self.orientation < 0:
+            # Bottom-up storage (BMP, TGA)
+            row = self.bottom - self.top - 1 - row
+        return self.offset + row * self.stride
+
+
+def raw_layout(img):
+    """Return the RawStrips describing img's pixel data, or None if it isn't plain raw rows.
+
+    img must be freshly opened (not yet loaded).
+    """
+    if not img.tile or img.mode not in RAWMODE_BITS:
+        return None
+    width = img.size[0]
+    strips = []
+    for decoder, extents, offset, args in img.tile:
+        if decoder != "raw":
+            return None
+        left, top, right, bottom = extents
+        if left != 0 or right != width:
+            return None
+        if isinstance(args, str):
+            args = (args, 0, 1)
+        rawmode = args[0]
+        stride = args[1] if len(args) > 1 else 0
+        orientation = args[2] if len(args) > 2 else 1
+        bits = RAWMODE_BITS.get(rawmode)
+        if bits is None:
+            return None
+        bytes_per_pixel = bits // 8
+        if stride <= 0:
+            stride = width * bytes_per_pixel
+        strips.append(RawStrip(top, bottom, offset, rawmode, stride, orientation, bytes_per_pixel))
+    strips.sort(key=lambda strip: strip.top)
+
+    # The strips must cover every row exactly once and share one raw layout
+    expected_top = 0
+    for strip in strips:
+        if strip.top != expected_top or strip.rawmode != strips[0].rawmode:
+            return None
+        expected_top = strip.bottom
+    if expected_top != img.size[1]:
+        return None
+    return strips
+
+
+def _strip_for_row(strips, y):
+    for strip in strips:
+        if strip.top <= y < strip.bottom:
+            return strip
+    raise ValueError(f"Row {y} is outside the image")
+
+
+def read_rows(fp, strips, box, top, bottom):
+    """Read rows [top, bottom) of box as raw bytes in top-to-bottom order"""
+    left, _, right, _ = box
+    chunks = []
+    for y in range(top, bottom):
+        strip = _strip_for_row(strips, y)
+        fp.seek(strip.row_offset(y) + left * strip.bytes_per_pixel)
+        chunks.append(fp.read((right - left) * strip.bytes_per_pixel))
+    return b"".join(chunks)
+
+
+def map_file(img):
+    """Read-only memory map of an unloaded image's file, or None if it can't be mapped"""
+    try:
+        return mmap.mmap(img.fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        # In-memory streams have no fileno(); empty or special files can't be mapped
+        return None
+
+
+def release_pages(mapped, start, length):
+    """Drop mapped file pages that were already decoded from this process's resident memory"""
+    if not hasattr(mmap, "MADV_DONTNEED"):
+        return
+    aligned = start - start % mmap.PAGESIZE
+    try:
+        mapped.madvise(mmap.MADV_DONTNEED, aligned, length + start - aligned)
+    except OSError:
+        pass
+
+
+def _map_rows(mapped, strip, box, top, bottom):
+    """(start, length) of the mapped bytes holding rows [top, bottom) of box within strip.
+
+    box must lie inside the image; read_region clips it first.
+    """
+    left, right = box[0], box[2]
+    # The lowest file offset is the first row for top-down strips and the last for bottom-up ones
+    first = top if strip.orientation > 0 else bottom - 1
+    start = strip.row_offset(first) + left * strip.bytes_per_pixel
+    length = (bottom - top - 1) * strip.stride + (right - left) * strip.bytes_per_pixel
+    if start + length > len(mapped):
+        raise ValueError("Image file is truncated")
+    return start, length
+
+
+def read_region(img, box, strips=None, band_rows=BAND_ROWS, mapped=None):
+    """Build the crop box of an unloaded raw image by reading only its rows and columns.
+
+    The result is pixel-identical to img.crop(box), including boxes that
+    reach outside the image. Rows are decoded band by
+    band, either straight from mapped (from map_file()) or through reads of
+    img.fp, so peak memory is the region plus one band of band_rows rows.
+    """
+    strips = strips or raw_layout(img)
+    if strips is None:
+        raise ValueError("Image data is not stored as raw rows")
+    left, top, right, bottom = box
+    width, height = right - left, bottom - top
+    rawmode = strips[0].rawmode
+
+    region = Image.new(img.mode, (width, height))
+    inside = (max(left, 0), max(top, 0), min(right, img.size[0]), min(bottom, img.size[1]))
+    if inside != tuple(box):
+        # Like crop(), the parts of box outside the image stay black (e.g.
+        # split panels wider than a portrait image start left of it)
+        if inside[0] < inside[2] and inside[1] < inside[3]:
+            region.paste(read_region(img, inside, strips, band_rows, mapped), (inside[0] - left, inside[1] - top))
+        if img.mode == "P" and img.palette is not None:
+            region.putpalette(img.palette)
+        return region
+    if mapped is not None:
+        with memoryview(mapped) as view:
+            for strip in strips:
+                for band_top in range(max(top, strip.top), min(bottom, strip.bottom), band_rows):
+                    band_bottom = min(band_top + band_rows, bottom, strip.bottom)
+                    start, length = _map_rows(mapped, strip, box, band_top, band_bottom)
+                    band = Image.new(img.mode, (width, band_bottom - band_top))
+                    with view[start:start + length] as rows:
+                        band.frombytes(rows, "raw", (rawmode, strip.stride, strip.orientation))
+                    region.paste(band, (0, band_top - top))
+                    release_pages(mapped, start, length)
+    else:
+        fp = img.fp
+        for band_top in range(top, bottom, band_rows):
+            band_bottom = min(band_top + band_rows, bottom)
+            data = read_rows(fp, strips, box, band_top, band_bottom)
+            band = Image.frombytes(img.mode, (width, band_bottom - band_top), data, "raw", rawmode)
+            region.paste(band, (0, band_top - top))
+
+    if img.mode == "P" and img.palette is not None:
+        # img.palette is parsed with the header; getpalette() would decode the image
+        region.putpalette(img.palette)
+    return region
@@ -0,0 +1,247 @@
+"""Persistent cache of preview proxies, thumbnails and image metadata for the GUI.
+
+Entries are keyed by the image's path and validated against its size and
+mtime, so edited files are decoded again. For every image the cache keeps
+its dimensions, EXIF orientation, how many carousel panels each preset can
+split it into, a small WEBP thumbnail (in the SQLite database itself) and
+optionally a copy of its screen-sized preview proxy (as a file next to the
+database; JPEG, which decodes about three times faster than WEBP, or WEBP
+when the image has transparency). Reopening a folder then reads thumbnails
+and proxies from the cache instead of decoding every original again.
+
+The cache is trimmed least-recently-used first once thumbnails and proxies
+together grow past max_bytes. It is safe to use from the preview loader's
+threads: all database access goes through one connection and a lock.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+
+from crop_engine import PRESETS, get_max_possible_panels, write_atomic
+
+# Bump when the stored data changes meaning; older databases are emptied
+SCHEMA_VERSION = 1
+
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+
+# Entries read per query when trimming the cache
+EVICT_BATCH = 32
+
+DB_FILENAME = "previews.sqlite"
+
+# Lossy is fine for previews; method 0 keeps encoding off the critical path
+THUMB_WEBP_OPTIONS = {"quality": 80, "method": 0}
+PROXY_JPEG_OPTIONS = {"quality": 90}
+PROXY_WEBP_OPTIONS = {"quality": 85, "method": 0}
+
+EXIF_ORIENTATION = 0x0112
+
+logger = logging.getLogger("instagram_crop.thumbs")
+
+
+def split_eligibility(size, presets=PRESETS):
+    """Maximum panel count per preset for an image of this size (0 when it can't be split)"""
+    return {name: get_max_possible_panels(size, preset) if preset["size"] else 0
+            for name, preset in presets.items()}
+
+
+def exif_orientation(img):
+    """EXIF orientation tag of an opened image (1 when absent)"""
+    try:
+        return int(img.getexif().get(EXIF_ORIENTATION, 1))
+    except Exception:
+        return 1
+
+
+def encode_preview(img, save_format, options):
+    if img.mode not in ("RGB", "RGBA") or (save_format == "JPEG" and img.mode != "RGB"):
+        img = img.convert("RGBA" if "A" in img.getbands() and save_format != "JPEG" else "RGB")
+    buffer = io.BytesIO()
+    img.save(buffer, format=save_format, **options)
+    return buffer.getvalue()
+
+
+class ThumbCache:
+    """SQLite index of image metadata and thumbnails plus WEBP preview proxies"""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.proxies_dir = os.path.join(cache_dir, "proxies")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cache_dir, DB_FILENAME), timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        # Running size of thumbnails and proxies, so put() doesn't sum every row
+        self._total_bytes = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+
+    def _create_schema(self):
+        with self.lock, self.db:
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self.db.execute("DROP TABLE IF EXISTS entries")
+                self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    orientation INTEGER NOT NULL,
+                    panels TEXT NOT NULL,
+                    thumbnail BLOB,
+                    proxy TEXT,
+                    bytes INTEGER NOT NULL DEFAULT 0,
+                    last_used REAL NOT NULL
+                )""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _proxy_path(self, name):
+        return os.path.join(self.proxies_dir, name)
+
+    def _valid_row(self, path, columns):
+        """Row of columns for path if it is cached for the file's current size and mtime"""
+        key = os.path.realpath(path)
+        try:
+            st = os.stat(key)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.db.execute(f"SELECT size, mtime_ns, {columns} FROM entries WHERE path = ?",
+                                  (key,)).fetchone()
+            if row is None:
+                return None
+            if (row[0], row[1]) != (st.st_size, st.st_mtime_ns):
+                # The file changed since it was cached
+                self._delete(key)
+                return None
+            with self.db:
+                self.db.execute("UPDATE entries SET last_used = ? WHERE path = ?", (time.time(), key))
+        return row[2:]
+
+    def metadata(self, path):
+        """Dict with width, height, orientation and panels (per preset) of path, or None"""
+        row = self._valid_row(path, "width, height, orientation, panels")
+        if row is None:
+            return None
+        width, height, orientation, panels = row
+        return {"width": width, "height": height, "orientation": orientation, "panels": json.loads(panels)}
+
+    def thumbnail(self, path):
+        """Cached thumbnail of path as a PIL image, or None"""
+        row = self._valid_row(path, "thumbnail")
+        if row is None or row[0] is None:
+            return None
+        img = Image.open(io.BytesIO(row[0]))
+        img.load()
+        return img
+
+    def proxy(self, path):
+        """Cached (proxy, full-resolution size) of path, or None"""
+        row = self._valid_row(path, "proxy, width, height")
+        if row is None or row[0] is None:
+            return None
+        name, width, height = row
+        try:
+            img = Image.open(self._proxy_path(name))
+            img.load()
+        except OSError:
+            return None
+        return img, (width, height)
+
+    def put(self, path, full_size, orientation=1, thumbnail=None, proxy=None):
+        """Record path's metadata and optionally its thumbnail and proxy (PIL images).
+
+        Whatever was cached for path before and isn't passed again is kept
+        as long as the file itself is unchanged.
+        """
+        key = os.path.realpath(path)
+        try:
+            st = os.stat(key)
+        except OSError:
+            return
+        thumb_data = encode_preview(thumbnail, "WEBP", THUMB_WEBP_OPTIONS) if thumbnail is not None else None
+        proxy_name = proxy_size = None
+        if proxy is not None:
+            proxy_name = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+            if "A" in proxy.getbands() or "transparency" in proxy.info:
+                proxy_name += ".webp"
+                data = encode_preview(proxy, "WEBP", PROXY_WEBP_OPTIONS)
+            else:
+                proxy_name += ".jpg"
+                data = encode_preview(proxy, "JPEG", PROXY_JPEG_OPTIONS)
+            try:
+                os.makedirs(self.proxies_dir, exist_ok=True)
+                write_atomic(data, self._proxy_path(proxy_name))
+                proxy_size = len(data)
+            except OSError as e:
+                # A full or read-only cache must not break the preview
+                logger.warning("Could not cache preview of %s: %s", path, e)
+                proxy_name = None
+
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, thumbnail, proxy, bytes FROM entries WHERE path = ?",
+                                  (key,)).fetchone()
+            if row is not None and (row[0], row[1]) == (st.st_size, st.st_mtime_ns):
+                thumb_data = thumb_data if thumb_data is not None else row[2]
+                proxy_name = proxy_name or row[3]
+            if proxy_name and proxy_size is None:
+                try:
+                    proxy_size = os.path.getsize(self._proxy_path(proxy_name))
+                except OSError:
+                    proxy_name, proxy_size = None, None
+            size_bytes = len(thumb_data or b"") + (proxy_size or 0)
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, st.st_size, st.st_mtime_ns, full_size[0], full_size[1], orientation,
+                     json.dumps(split_eligibility(full_size)), thumb_data, proxy_name, size_bytes, time.time()))
+            self._total_bytes += size_bytes - (row[4] if row is not None else 0)
+        self.evict()
+
+    def _delete(self, key):
+        """Remove an entry and its proxy file; the lock must be held"""
+        row = self.db.execute("SELECT proxy, bytes FROM entries WHERE path = ?", (key,)).fetchone()
+        if row is None:
+            return
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE path = ?", (key,))
+        self._total_bytes -= row[1]
+        if row[0]:
+            try:
+                os.remove(self._proxy_path(row[0]))
+            except OSError:
+                pass
+
+    @property
+    def total_bytes(self):
+        with self.lock:
+            return self._total_bytes
+
+    def evict(self):
+        """Drop least recently used entries until thumbnails and proxies fit in max_bytes"""
+        with self.lock:
+            while self._total_bytes > self.max_bytes:
+                # Oldest few at a time, read through the last_used index
+                rows = self.db.execute("SELECT path FROM entries ORDER BY last_used LIMIT ?",
+                                       (EVICT_BATCH,)).fetchall()
+                if not rows:
+                    break
+                for (key,) in rows:
+                    self._delete(key)
+                    if self._total_bytes <= self.max_bytes:
+                        break